@@ -1,6 +1,7 @@
 # app.py - 合并后的完整文件
 import os
 import json
+import time
 import re
 from datetime import datetime, date, timedelta
 from functools import wraps
@@ -10,16 +11,30 @@ from wtforms import StringField, SubmitField, PasswordField, SelectField
 from wtforms.validators import DataRequired, Length
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 import io
-from flask import send_file
+from flask import send_file, Response, stream_with_context
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment
-import zipfile
 import requests
 import tempfile
-import shutil
 import urllib
+import unicodedata
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from openai import OpenAI
+from storage import (create_storage, fcntl, ADD_OK, ADD_LIMIT, ADD_DUPLICATE_SONG,
+                     ADD_DUPLICATE_STUDENT)
+from state_store import StateStore
+from review import (VerdictStore, ReviewJobManager, PreScreen, JsonArrayParser,
+                    review_in_batches, parse_review_json)
+from cache import TTLCache
+from download_queue import DownloadQueue
+from zip_builder import ZipJobManager, stream_zip
+from audio_cache import AudioCache, is_cache_filename
+from upstream import UpstreamClient, IncompleteDownload, CircuitBreaker, CircuitOpen
+from ratelimit import RateLimiter, RateLimited
 
 
 
@@ -36,10 +51,27 @@ os.makedirs(app.config['SONG_DOWNLOAD_DIR'], exist_ok=True)
 app.config['DEEPSEEK_API_KEY'] = os.environ.get('DEEPSEEK_API_KEY') or '替换为你的deepseekapi'
 
 
+# 点歌列表存储后端：json（默认，每天一个JSON文件）、journal（JSON快照 + 追加日志）或 sqlite（WAL模式）
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND') or 'json'
+app.config['SQLITE_DB_PATH'] = os.path.join(app.config['DATA_DIR'], 'music.db')
+app.config['JOURNAL_FSYNC_WINDOW'] = 0.005  # 日志组提交窗口（秒）
+app.config['STORAGE_COMPACT_INTERVAL'] = 5  # 日志合并回快照的间隔（分钟）
+
 # 确保数据目录存在
 os.makedirs(app.config['DATA_DIR'], exist_ok=True)
 import sys
 
+storage = create_storage(
+    app.config['STORAGE_BACKEND'],
+    app.config['DATA_DIR'],
+    sqlite_path=app.config['SQLITE_DB_PATH'],
+    fsync_window=app.config['JOURNAL_FSYNC_WINDOW']
+)
+
+# 系统状态、公告、账户、更新日志等小文件统一从内存读取，文件变更后自动重新加载
+app.config['STATE_POLL_INTERVAL'] = 2  # 检查文件变更的间隔（秒）
+state_store = StateStore(poll_interval=app.config['STATE_POLL_INTERVAL'])
+
 # 定义年级和班级选项
 GRADE_CLASS_OPTIONS = {
     '初一': [f'初一{i}班' for i in range(1, 19)],  # 1-18班
@@ -53,29 +85,18 @@ GRADE_CLASS_OPTIONS = {
 # 系统状态管理
 STATUS_FILE = os.path.join(app.config['DATA_DIR'], 'system_status.json')
 
+state_store.register('system_status', STATUS_FILE, {
+    'requests_paused': False,
+    'pause_reason': ''
+})
+
 def get_system_status():
     """获取系统状态"""
-    if os.path.exists(STATUS_FILE):
-        try:
-            with open(STATUS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
-    
-    # 默认状态
-    return {
-        'requests_paused': False,
-        'pause_reason': ''
-    }
+    return state_store.get('system_status')
 
 def save_system_status(status):
     """保存系统状态"""
-    try:
-        with open(STATUS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(status, f, ensure_ascii=False, indent=2)
-        return True
-    except:
-        return False
+    return state_store.set('system_status', status)
 
 def is_requests_paused():
     """检查点歌是否被暂停"""
@@ -114,6 +135,22 @@ def validate_date_string(date_string):
     except ValueError:
         return False
 
+def sanitize_filename(name):
+    """统一的文件名清理函数"""
+    # 移除或替换非法字符
+    illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
+    for char in illegal_chars:
+        name = name.replace(char, '_')
+    
+    # 移除控制字符
+    name = ''.join(char for char in name if ord(char) >= 32)
+    
+    # 限制长度
+    if len(name) > 100:
+        name = name[:100]
+    
+    return name.strip()
+
 # 表单类 - 点歌表单
 class SongRequestForm(FlaskForm):
     song_name = StringField('歌曲名称', validators=[
@@ -152,9 +189,9 @@ class LoginForm(FlaskForm):
     
     submit = SubmitField('登录')
 
-# JSON文件处理函数
-def get_today_filename(create_if_not_exists=False):
-    """获取当天数据文件的路径"""
+# 点歌列表读写函数（具体存储由 storage 后端负责）
+def get_today_date_str():
+    """获取当前点歌列表对应的日期"""
     # 判断当前时间是否在18:00之后
     now = datetime.now()
     target_date = date.today()
@@ -163,219 +200,305 @@ def get_today_filename(create_if_not_exists=False):
     if now.hour >= 18:
         target_date = target_date + timedelta(days=1)
     
-    today_str = target_date.isoformat()
-    filename = os.path.join(app.config['DATA_DIR'], f"{today_str}.json")
-    
-    # 只有在明确要求时才创建文件
-    if create_if_not_exists and not os.path.exists(filename):
-        save_daily_list([])
-    
-    return filename
+    return target_date.isoformat()
 
 def get_daily_list(date_str=None):
     """获取指定日期的歌曲列表"""
     if not date_str:
-        filename = get_today_filename()
-    else:
+        date_str = get_today_date_str()
+    elif not validate_date_string(date_str):
         # 防止路径遍历攻击
-        if not validate_date_string(date_str):
-            return []
-        filename = os.path.join(app.config['DATA_DIR'], f"{date_str}.json")
-    
-    # 确保文件路径在数据目录内
-    if not os.path.abspath(filename).startswith(os.path.abspath(app.config['DATA_DIR'])):
         return []
     
-    if os.path.exists(filename):
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    return storage.load(date_str)
 
 def save_daily_list(data, date_str=None):
     """保存指定日期的歌曲列表"""
     if not date_str:
-        filename = get_today_filename()
-    else:
+        date_str = get_today_date_str()
+    elif not validate_date_string(date_str):
         # 防止路径遍历攻击
-        if not validate_date_string(date_str):
-            return False
-        filename = os.path.join(app.config['DATA_DIR'], f"{date_str}.json")
-    
-    # 确保文件路径在数据目录内
-    if not os.path.abspath(filename).startswith(os.path.abspath(app.config['DATA_DIR'])):
         return False
     
-    try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        return True
-    except:
-        return False
+    return storage.save(date_str, data)
     
 def get_daily_request_count():
     """获取当日已点歌曲数量"""
-    today_list = get_daily_list()
-    return len(today_list)
+    return storage.count(get_today_date_str())
 
 def get_remaining_requests():
     """获取剩余可点歌数量"""
     count = get_daily_request_count()
     return max(0, MAX_DAILY_REQUESTS - count)
-def download_single_song(song_id, song_name, artist=''):
+# Song_V1 歌曲信息缓存：播放链接按上游签名链接的有效期缓存，歌词长期缓存
+app.config['SONG_URL_TTL'] = 20 * 60  # 播放链接缓存时间（秒），应小于上游签名链接的有效期
+app.config['SONG_URL_STALE_TTL'] = 5 * 60  # 过期后仍可先返回旧链接、后台刷新的时间窗口（秒）
+app.config['SONG_LYRIC_TTL'] = 7 * 24 * 3600  # 歌词缓存时间（秒）
+# 上游熔断、限流或网络错误时，缓存返回最后一次的旧值（即使已过期）
+UPSTREAM_FALLBACK_ERRORS = (CircuitOpen, RateLimited, requests.exceptions.RequestException)
+song_url_cache = TTLCache('song_url', max_size=2048,
+                          ttl=app.config['SONG_URL_TTL'],
+                          stale_ttl=app.config['SONG_URL_STALE_TTL'],
+                          fallback_errors=UPSTREAM_FALLBACK_ERRORS)
+song_lyric_cache = TTLCache('song_lyric', max_size=4096, ttl=app.config['SONG_LYRIC_TTL'],
+                            fallback_errors=UPSTREAM_FALLBACK_ERRORS)
+
+# 页面渲染时并发解析播放链接：最大并发数和整体等待时间（秒）
+app.config['URL_RESOLVE_WORKERS'] = 8
+app.config['URL_RESOLVE_DEADLINE'] = 3
+url_resolve_pool = ThreadPoolExecutor(max_workers=app.config['URL_RESOLVE_WORKERS'],
+                                      thread_name_prefix='song-url')
+# 按需解析播放链接：页面只输出 /api/song_url 地址，播放时才解析
+app.config['LAZY_SONG_URLS'] = True
+
+# 上游接口和歌曲CDN共用的HTTP客户端：连接池复用连接，失败时带抖动重试
+app.config['UPSTREAM_CONNECT_TIMEOUT'] = 3.05  # 连接超时（秒）
+app.config['UPSTREAM_READ_TIMEOUT'] = 10  # 默认读取超时（秒）
+app.config['UPSTREAM_RETRIES'] = 2  # 连接失败、超时或 429/5xx 时的重试次数
+app.config['UPSTREAM_RETRY_BACKOFF'] = 0.3  # 第一次重试前的平均等待（秒），之后每次翻倍
+# 连接池大小：页面解析、后台下载和打包任务的并发数之和，再留一些给请求线程
+app.config['UPSTREAM_POOL_SIZE'] = app.config['URL_RESOLVE_WORKERS'] + 2 * app.config['MAX_CONCURRENT_DOWNLOADS'] + 4
+
+# 上游限流：按 (主机, 优先级) 的令牌桶，所有 worker 进程共享额度
+# interactive：搜索、播放地址等学生/管理员正在等待的请求；background：后台下载、打包和预取
+app.config['UPSTREAM_RATE_LIMITS'] = {
+    'api.zh-mc.top': {
+        'interactive': (8, 20),  # (每秒请求数, 突发容量)
+        'background': (2, 4)
+    }
+}
+# 额度用完时最多等待的秒数，超过后立即返回“请稍后再试”
+app.config['UPSTREAM_RATE_MAX_WAIT'] = {
+    'interactive': 0.5,
+    'background': 30
+}
+upstream_limiter = RateLimiter(
+    os.path.join(app.config['DATA_DIR'], 'ratelimit.json'),
+    app.config['UPSTREAM_RATE_LIMITS'],
+    max_wait=app.config['UPSTREAM_RATE_MAX_WAIT']
+)
+
+# 熔断：连续失败或响应过慢达到阈值后，在 BREAKER_RESET_TIMEOUT 秒内不再请求该主机，
+# 页面和搜索改用缓存中的旧数据；之后放行一个探测请求，成功则恢复
+app.config['BREAKER_HOSTS'] = ('api.zh-mc.top',)
+app.config['BREAKER_FAILURE_THRESHOLD'] = 5  # 连续失败次数
+app.config['BREAKER_SLOW_CALL_SECONDS'] = 5  # 超过这个耗时的请求也算失败
+app.config['BREAKER_RESET_TIMEOUT'] = 30  # 熔断后多久开始探测（秒）
+upstream = UpstreamClient(
+    pool_size=app.config['UPSTREAM_POOL_SIZE'],
+    connect_timeout=app.config['UPSTREAM_CONNECT_TIMEOUT'],
+    read_timeout=app.config['UPSTREAM_READ_TIMEOUT'],
+    retries=app.config['UPSTREAM_RETRIES'],
+    backoff=app.config['UPSTREAM_RETRY_BACKOFF'],
+    limiter=upstream_limiter,
+    breakers=[CircuitBreaker(host,
+                             failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+                             slow_call_seconds=app.config['BREAKER_SLOW_CALL_SECONDS'],
+                             reset_timeout=app.config['BREAKER_RESET_TIMEOUT'])
+              for host in app.config['BREAKER_HOSTS']]
+)
+
+# 音质：管理后台播放（广播）使用高音质，学生页面试听使用低码率
+# 可以用 ?level= 参数指定，浏览器发送 Save-Data: on 时使用试听音质
+app.config['AUDIO_LEVELS'] = ('standard', 'higher', 'exhigh', 'lossless')  # Song_V1 支持的音质，码率从低到高
+app.config['BROADCAST_LEVEL'] = 'exhigh'
+app.config['PREVIEW_LEVEL'] = 'standard'
+
+def pick_audio_level(default, save_data=True):
     """
-    下载单首歌曲到本地
+    根据请求参数和 Save-Data 请求头选择音质
+    save_data=False 时忽略 Save-Data（管理页播放使用的播放音质不降级）
     """
-    if not song_id:
-        return None, "缺少歌曲ID"
-    
+    level = request.args.get('level')
+    if level in app.config['AUDIO_LEVELS']:
+        return level
+    if save_data and request.headers.get('Save-Data', '').lower() == 'on':
+        return app.config['PREVIEW_LEVEL']
+    return default
+
+class SongInfoError(Exception):
+    """Song_V1 接口返回失败或缺少数据"""
+
+def fetch_song_v1(song_id, level='standard', timeout=10):
+    """
+    请求上游 Song_V1 接口，并把结果写入播放链接和歌词缓存
+    返回接口中的 data 字典
+    """
+    params = {
+        'url': song_id,
+        'level': level,
+        'type': 'json'
+    }
+    response = upstream.get(
+        'https://api.zh-mc.top/Song_V1',
+        params=params,
+        timeout=timeout
+    )
+    response.raise_for_status()
+    
+    song_data = response.json()
+    if not song_data.get('success') or not song_data.get('data'):
+        raise SongInfoError(song_data.get('message', '获取歌曲信息失败'))
+    
+    data = song_data['data']
+    # 一次请求同时得到链接和歌词，两个缓存都填上
+    if data.get('url'):
+        song_url_cache.set((song_id, level), data['url'])
+    song_lyric_cache.set(song_id, data.get('lyric', ''))
+    return data
+
+def get_song_url(song_id, level='standard', timeout=10):
+    """获取歌曲播放链接（优先使用缓存），上游没有链接时返回空字符串"""
+    def load():
+        return fetch_song_v1(song_id, level, timeout).get('url') or None
+    return song_url_cache.get_or_load((song_id, level), load) or ''
+
+def get_song_lyric(song_id, level='standard', timeout=10, refresh=False):
+    """
+    获取歌词（优先使用缓存）；歌词与音质无关，只按歌曲ID缓存
+    refresh=True 时重新请求，请求失败时仍返回缓存中的旧歌词
+    """
+    def load():
+        return fetch_song_v1(song_id, level, timeout).get('lyric', '')
+    return song_lyric_cache.get_or_load(song_id, load, force=refresh) or ''
+
+# 本地歌曲文件缓存：按 song_id 和音质存放，超过容量时淘汰最久未播放的文件
+app.config['AUDIO_CACHE_INDEX'] = os.path.join(app.config['DATA_DIR'], 'audio_cache.json')
+app.config['AUDIO_CACHE_MAX_BYTES'] = 2 * 1024 ** 3  # 缓存总大小上限（字节）
+app.config['AUDIO_CACHE_POLICY'] = 'lru'  # 淘汰策略：lru（最久未访问）或 lfu（访问次数最少）
+app.config['AUDIO_CACHE_MAINTAIN_INTERVAL'] = 10  # 写回访问记录、清理无效文件的间隔（分钟）
+audio_cache = AudioCache(
+    app.config['SONG_DOWNLOAD_DIR'],
+    app.config['AUDIO_CACHE_MAX_BYTES'],
+    policy=app.config['AUDIO_CACHE_POLICY'],
+    index_path=app.config['AUDIO_CACHE_INDEX']
+)
+
+app.config['DOWNLOAD_RESUME_ATTEMPTS'] = 3  # 单次下载中断后用 Range 续传的最多尝试次数
+_download_fallback_lock = threading.Lock()  # 没有 fcntl 时所有下载共用的进程内锁
+
+@contextmanager
+def _download_lock(part_path):
+    """
+    同一个 .part 文件同时只能有一个线程或进程写入：在 .part.lock 文件上加 flock，
+    下载结束后删除锁文件
+    """
+    if fcntl is None:
+        with _download_fallback_lock:
+            yield
+        return
+    
+    lock_path = part_path + '.lock'
+    while True:
+        lock_file = open(lock_path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            current = os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino
+        except OSError:
+            current = False
+        if current:
+            break
+        # 等待期间持有者已删除锁文件，重新打开新的锁文件
+        lock_file.close()
     try:
-        # 使用API获取歌曲下载链接
-        params = {
-            'url': song_id,
-            'level': 'standard',
-            'type': 'json'
-        }
-        
-        response = requests.get(
-            'https://api.zh-mc.top/Song_V1',
-            params=params,
-            timeout=app.config['DOWNLOAD_TIMEOUT']
-        )
-        response.raise_for_status()
-        
-        song_data = response.json()
-        if not song_data.get('success') or not song_data.get('data'):
-            return None, song_data.get('message', '获取歌曲信息失败')
-        
-        download_url = song_data['data'].get('url')
-        if not download_url:
-            return None, "无法获取歌曲下载链接"
-        
-        # 下载歌曲
-        song_response = requests.get(
-            download_url, 
-            stream=True,
-            timeout=app.config['DOWNLOAD_TIMEOUT'],
-            headers={
-                'Referer': 'http://music.126.net/',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-            }
-        )
-        song_response.raise_for_status()
-        
-        def sanitize_filename(name):
-            """统一的文件名清理函数"""
-            # 移除或替换非法字符
-            illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-            for char in illegal_chars:
-                name = name.replace(char, '_')
-            
-            # 移除控制字符
-            name = ''.join(char for char in name if ord(char) >= 32)
-            
-            # 限制长度
-            if len(name) > 100:
-                name = name[:100]
-            
-            return name.strip()
-        
-        # 生成文件名
-        filename_title = song_name
-        song_filename = f"{sanitize_filename(filename_title)}.mp3"
-        song_filepath = os.path.join(app.config['SONG_DOWNLOAD_DIR'], song_filename)
-        
-        # 保存歌曲文件
-        with open(song_filepath, 'wb') as f:
-            for chunk in song_response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        return song_filepath, "下载成功"
-    
-    except requests.exceptions.RequestException as e:
-        return None, f"网络错误: {str(e)}"
-    except Exception as e:
-        return None, f"下载失败: {str(e)}"
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+        lock_file.close()
 
-def download_single_song(song_id, song_name, artist=''):
+def download_single_song(song_id, song_name, artist='', level='standard'):
     """
-    下载单首歌曲到本地，并返回歌词信息
+    下载单首歌曲到本地缓存，并返回歌词信息
+    已缓存的歌曲直接返回本地文件，不请求网络。
+    下载先写入 .part 文件，中断后续传（包括下载队列之后的重试），
+    长度校验完整后才原子地移入缓存，不会留下不完整的歌曲文件
     """
     if not song_id:
         return None, "缺少歌曲ID", None
     
+    cached_path = audio_cache.lookup(song_id, level)
+    if cached_path:
+        return cached_path, "使用本地缓存", song_lyric_cache.peek(song_id)
+    
     try:
-        # 使用API获取歌曲下载链接
-        params = {
-            'url': song_id,
-            'level': 'standard',
-            'type': 'json'
-        }
-        
-        response = requests.get(
-            'https://api.zh-mc.top/Song_V1',
-            params=params,
-            timeout=app.config['DOWNLOAD_TIMEOUT']
-        )
-        response.raise_for_status()
-        
-        song_data = response.json()
-        if not song_data.get('success') or not song_data.get('data'):
-            return None, song_data.get('message', '获取歌曲信息失败'), None
-        
-        download_url = song_data['data'].get('url')
-        lyric = song_data['data'].get('lyric', '')  # 获取歌词
-        
-        if not download_url:
-            return None, "无法获取歌曲下载链接", lyric
-        
-        # 下载歌曲
-        song_response = requests.get(
-            download_url, 
-            stream=True,
-            timeout=app.config['DOWNLOAD_TIMEOUT'],
-            headers={
-                'Referer': 'http://music.126.net/',
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
-            }
-        )
-        song_response.raise_for_status()
-        
-        def sanitize_filename(name):
-            """统一的文件名清理函数"""
-            # 移除或替换非法字符
-            illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-            for char in illegal_chars:
-                name = name.replace(char, '_')
+        part_path = audio_cache.path_for(song_id, level) + '.part'
+        with _download_lock(part_path):
+            # 等待期间其他线程可能已经下载完成
+            cached_path = audio_cache.lookup(song_id, level)
+            if cached_path:
+                return cached_path, "使用本地缓存", song_lyric_cache.peek(song_id)
             
-            # 移除控制字符
-            name = ''.join(char for char in name if ord(char) >= 32)
+            # 获取歌曲下载链接和歌词（同一次 Song_V1 请求，结果会被缓存）
+            download_url = get_song_url(song_id, level, timeout=app.config['DOWNLOAD_TIMEOUT'])
+            lyric = get_song_lyric(song_id, level, timeout=app.config['DOWNLOAD_TIMEOUT'])
             
-            # 限制长度
-            if len(name) > 100:
-                name = name[:100]
+            if not download_url:
+                return None, "无法获取歌曲下载链接", lyric
             
-            return name.strip()
-        
-        # 生成文件名
-        filename_title = song_name
-        song_filename = f"{sanitize_filename(filename_title)}.mp3"
-        song_filepath = os.path.join(app.config['SONG_DOWNLOAD_DIR'], song_filename)
-        
-        # 保存歌曲文件
-        with open(song_filepath, 'wb') as f:
-            for chunk in song_response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        return song_filepath, "下载成功", lyric
-    
+            # 下载歌曲
+            upstream.download(
+                download_url,
+                part_path,
+                attempts=app.config['DOWNLOAD_RESUME_ATTEMPTS'],
+                timeout=app.config['DOWNLOAD_TIMEOUT'],
+                headers={
+                    'Referer': 'http://music.126.net/',
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'
+                }
+            )
+            
+            song_filepath = audio_cache.put(song_id, level, part_path, song_name)
+            return song_filepath, "下载成功", lyric
+    
+    except SongInfoError as e:
+        return None, str(e), None
+    except (RateLimited, CircuitOpen) as e:
+        return None, f"上游繁忙: {str(e)}", None
+    except IncompleteDownload as e:
+        return None, f"下载不完整: {str(e)}", None
     except requests.exceptions.RequestException as e:
         return None, f"网络错误: {str(e)}", None
     except Exception as e:
         return None, f"下载失败: {str(e)}", None
 
+# 后台下载队列：点歌后的下载不再阻塞请求，最多 MAX_CONCURRENT_DOWNLOADS 首同时下载
+app.config['DOWNLOAD_QUEUE_FILE'] = os.path.join(app.config['DATA_DIR'], 'download_queue.json')
+app.config['DOWNLOAD_MAX_ATTEMPTS'] = 4  # 失败后最多尝试次数
+app.config['DOWNLOAD_RETRY_BACKOFF'] = 10  # 第一次重试前等待秒数，之后每次翻倍
+def download_broadcast_song(song_id, song_name, artist=''):
+    """下载广播音质的歌曲（点歌后由后台队列调用）"""
+    with upstream.priority('background'):
+        return download_single_song(song_id, song_name, artist, level=app.config['BROADCAST_LEVEL'])
+
+download_queue = DownloadQueue(
+    app.config['DOWNLOAD_QUEUE_FILE'],
+    download_broadcast_song,
+    workers=app.config['MAX_CONCURRENT_DOWNLOADS'],
+    max_attempts=app.config['DOWNLOAD_MAX_ATTEMPTS'],
+    retry_backoff=app.config['DOWNLOAD_RETRY_BACKOFF'],
+)
+
+@app.route('/api/download_status/<song_id>')
+def api_download_status(song_id):
+    """查询歌曲后台下载状态，下载完成后返回本地文件链接"""
+    job = download_queue.status(song_id)
+    if job is None:
+        return jsonify({'success': False, 'state': None, 'ready': False, 'message': '没有该歌曲的下载任务'}), 404
+    ready = job['state'] == 'done' and bool(job.get('file')) and os.path.exists(job['file'])
+    result = {
+        'success': True,
+        'state': job['state'],
+        'ready': ready,
+        'attempts': job['attempts'],
+        'message': job['message'],
+    }
+    if ready:
+        result['download_url'] = url_for('download_song_file', filename=os.path.basename(job['file']))
+    return jsonify(result)
+
 @app.route('/download_song_file/<filename>')
 def download_song_file(filename):
     """
@@ -384,64 +507,156 @@ def download_song_file(filename):
     try:
         # 防止路径遍历攻击
         filename = os.path.basename(filename)
-        file_path = os.path.join(app.config['SONG_DOWNLOAD_DIR'], filename)
         
-        if not os.path.exists(file_path):
-            return "文件不存在", 404
+        # 缓存文件按歌曲ID命名，下载时使用歌名
+        entry = audio_cache.entry(filename)
+        download_name = f"{sanitize_filename(entry['song_name'])}.mp3" if entry and entry['song_name'] else filename
         
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=filename,
-            mimetype='audio/mpeg'
-        )
+        response = send_audio_file(filename, as_attachment=True, download_name=download_name)
+        if response is None:
+            return "文件不存在", 404
+        return response
     except Exception as e:
         return f"下载失败: {str(e)}", 500
-def add_song_urls_to_requests(requests_list):
-    """为歌曲列表添加播放URL"""
+
+# 缓存中的歌曲文件名只由歌曲ID和音质决定，文件被淘汰后重新下载的内容可能不同，
+# 所以只短时间缓存，过期后浏览器用 ETag / Last-Modified 重新验证（未变化时返回304）
+app.config['AUDIO_MAX_AGE'] = 600  # 秒
+
+# 文件发送方式：''（由 Flask 发送）、'nginx'（X-Accel-Redirect）或 'sendfile'（X-Sendfile，Apache/lighttpd）
+# 后两种方式下视图只负责检查路径，文件内容由前端服务器发送，不占用 Python worker
+app.config['FILE_OFFLOAD'] = os.environ.get('FILE_OFFLOAD') or ''
+app.config['USE_X_SENDFILE'] = app.config['FILE_OFFLOAD'] == 'sendfile'
+# nginx 中对应 internal location 的前缀，配置示例见 deploy/nginx.conf
+app.config['ACCEL_REDIRECT_LOCATIONS'] = {
+    'audio': '/_protected/audio/',
+    'zip': '/_protected/zip/'
+}
+
+def offload_file(kind, filename, mimetype, as_attachment=False, download_name=None):
+    """
+    返回只带 X-Accel-Redirect 头的空响应，由 nginx 发送文件
+    Range、ETag 和 304 由 nginx 处理；Content-Type、Content-Disposition、Cache-Control 会原样转发
+    """
+    response = Response(mimetype=mimetype)
+    response.headers['X-Accel-Redirect'] = app.config['ACCEL_REDIRECT_LOCATIONS'][kind] + urllib.parse.quote(filename)
+    if as_attachment:
+        download_name = download_name or filename
+        try:
+            download_name.encode('ascii')
+            names = {'filename': download_name}
+        except UnicodeEncodeError:
+            simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+            names = {'filename': simple, 'filename*': "UTF-8''" + urllib.parse.quote(download_name, safe="!#$&+-.^_`|~")}
+        response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
+def send_audio_file(filename, **kwargs):
+    """
+    发送缓存中的歌曲文件，文件不存在时返回 None
+    支持 Range（拖动进度条只请求需要的部分）和 If-None-Match / If-Modified-Since（返回304），
+    ETag 由文件名、大小和修改时间生成
+    """
+    if not is_cache_filename(filename):
+        return None
+    file_path = os.path.join(app.config['SONG_DOWNLOAD_DIR'], filename)
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    
+    if app.config['FILE_OFFLOAD'] == 'nginx':
+        response = offload_file('audio', filename, 'audio/mpeg', **kwargs)
+        response.cache_control.max_age = app.config['AUDIO_MAX_AGE']
+        response.cache_control.public = True
+        return response
+    
+    response = send_file(
+        file_path,
+        mimetype='audio/mpeg',
+        conditional=True,
+        etag=f"{filename[:-4]}-{st.st_size:x}-{st.st_mtime_ns:x}",
+        last_modified=st.st_mtime,
+        max_age=app.config['AUDIO_MAX_AGE'],
+        **kwargs
+    )
+    response.cache_control.public = True
+    return response
+def find_local_song_file(song_id, level='standard'):
+    """返回本地缓存中该歌曲的文件名，不存在时返回 None"""
+    path = audio_cache.lookup(song_id, level)
+    return os.path.basename(path) if path else None
+
+def _resolve_song_info(song_id, with_lyric, level):
+    url = get_song_url(song_id, level)
+    lyric = get_song_lyric(song_id) if with_lyric else None
+    return url, lyric
+
+def resolve_play_url(song, level='standard'):
+    """
+    获取单首歌曲指定音质的播放地址，返回 (url, 来源)
+    依次尝试：本地已下载的文件 -> 缓存中的上游链接 -> 请求上游
+    """
+    local_filename = find_local_song_file(song.get('song_id'), level)
+    if local_filename:
+        return f"/data/downloads/{local_filename}", 'local'
+    
+    song_id = song.get('song_id')
+    if not song_id:
+        return '', 'none'
+    
+    cached_url = song_url_cache.peek((song_id, level), allow_stale=True)
+    if cached_url:
+        return cached_url, 'cache'
+    
+    return get_song_url(song_id, level), 'upstream'
+
+def add_song_urls_to_requests(requests_list, with_lyric=False, level='standard'):
+    """
+    为歌曲列表添加指定音质的播放URL（with_lyric 时同时补充歌词）
+    本地已下载的歌曲直接使用本地文件。
+    LAZY_SONG_URLS 开启时其余歌曲使用 /api/song_url 按需解析，渲染页面不请求上游；
+    关闭时并发向上游解析，超过 URL_RESOLVE_DEADLINE 仍未完成的歌曲标记 url_pending，
+    不阻塞页面渲染，后台会继续解析并写入缓存，刷新页面后即可播放
+    """
+    pending = {}
     for request in requests_list:
-        song_name = request.get('song_name', '')
-        
-        def sanitize_filename(name):
-            illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-            for char in illegal_chars:
-                name = name.replace(char, '_')
-            name = ''.join(char for char in name if ord(char) >= 32)
-            if len(name) > 100:
-                name = name[:100]
-            return name.strip()
-        
-        filename_title = song_name
-        expected_filename = f"{sanitize_filename(filename_title)}.mp3"
-        expected_filepath = os.path.join(app.config['SONG_DOWNLOAD_DIR'], expected_filename)
-        
-        if os.path.exists(expected_filepath):
-            request['url'] = f"/data/downloads/{expected_filename}"
+        request['url'] = ''
+        request['url_pending'] = False
+        
+        local_filename = find_local_song_file(request.get('song_id'), level)
+        if local_filename:
+            request['url'] = f"/data/downloads/{local_filename}"
+            continue
+        
+        song_id = request.get('song_id')
+        if not song_id:
+            continue
+        
+        if app.config['LAZY_SONG_URLS']:
+            # 播放器真正播放到这首歌时才会请求这个地址
+            request['url'] = url_for('api_song_url', request_id=request['id'], redirect=1, level=level)
+            if with_lyric and not request.get('lyric'):
+                request['lyric'] = song_lyric_cache.peek(song_id) or ''
         else:
-            song_id = request.get('song_id')
-            if song_id:
-                try:
-                    params = {
-                        'url': song_id,
-                        'level': 'standard',
-                        'type': 'json'
-                    }
-                    response = requests.get(
-                        'https://api.zh-mc.top/Song_V1',
-                        params=params,
-                        timeout=10
-                    )
-                    response.raise_for_status()
-                    song_data = response.json()
-                    if song_data.get('success') and song_data.get('data'):
-                        request['url'] = song_data['data'].get('url', '')
-                    else:
-                        request['url'] = ''
-                except Exception as e:
-                    app.logger.error(f"获取歌曲URL失败: {str(e)}")
-                    request['url'] = ''
-            else:
-                request['url'] = ''
+            pending[url_resolve_pool.submit(_resolve_song_info, song_id, with_lyric, level)] = request
+    
+    if not pending:
+        return requests_list
+    
+    done, not_done = wait(pending, timeout=app.config['URL_RESOLVE_DEADLINE'])
+    for future in done:
+        request = pending[future]
+        try:
+            url, lyric = future.result()
+            request['url'] = url
+            if lyric:
+                request['lyric'] = lyric
+        except Exception as e:
+            app.logger.error(f"获取歌曲URL失败: {str(e)}")
+    for future in not_done:
+        pending[future]['url_pending'] = True
+    
     return requests_list
 
 # 修改 add_song_request 函数以添加审核状态
@@ -451,38 +666,16 @@ def add_song_request(song_name, class_name, student_name, song_id=None, cover_ur
     if is_requests_paused():
         return False, "点歌功能已暂停，请稍后再试"
     
-    # 检查是否达到每日限制
-    if get_daily_request_count() >= MAX_DAILY_REQUESTS:
-        return False, "今日点歌数量已达上限，请明天再来"
-    
     # 清理输入数据
     song_name = sanitize_input(song_name, 100)
     class_name = sanitize_input(class_name, 50)
     student_name = sanitize_input(student_name, 50)
     
-    # 解析歌曲名称和歌手（如果未提供艺术家信息）
-    artist = ""
+    # 解析歌曲名称
     title = song_name
-    today_list = get_daily_list()
-    
-    # 检查歌曲是否已存在（基于歌曲ID或歌曲名和歌手）
-    for item in today_list:
-        if song_id and item.get('song_id') == song_id:
-            return False, "该歌曲已被点过，请选择其他歌曲"
-        if item['song_name'].lower() == title.lower() and item.get('artist', '').lower() == artist.lower():
-            return False, "该歌曲已被点过，请选择其他歌曲"
     
-    # 检查同一姓名是否已点过歌
-    for item in today_list:
-        if item['student_name'] == student_name:
-            return False, "您已经点过一首歌了，每人只能点一首"
-    
-    # 生成唯一ID
-    new_id = max([item['id'] for item in today_list], default=0) + 1
-    
-    # 添加新请求
+    # 新请求（ID由存储后端分配）
     new_song_request = {
-        'id': new_id,
         'song_name': title,
         'class_name': class_name,
         'student_name': student_name,
@@ -514,10 +707,17 @@ def add_song_request(song_name, class_name, student_name, song_id=None, cover_ur
     if 'lyric' not in new_song_request:
         new_song_request['lyric'] = ''
     
-    today_list.append(new_song_request)
+    # 检查每日限制、歌曲是否已存在、同一姓名是否已点过歌，并写入列表
+    status, _ = storage.add_request(get_today_date_str(), new_song_request, MAX_DAILY_REQUESTS)
     
-    if save_daily_list(today_list):
+    if status == ADD_OK:
         return True, "点歌请求已提交成功!"
+    elif status == ADD_LIMIT:
+        return False, "今日点歌数量已达上限，请明天再来"
+    elif status == ADD_DUPLICATE_SONG:
+        return False, "该歌曲已被点过，请选择其他歌曲"
+    elif status == ADD_DUPLICATE_STUDENT:
+        return False, "您已经点过一首歌了，每人只能点一首"
     else:
         return False, "提交失败，请稍后再试"
         
@@ -531,25 +731,51 @@ def vote_song(song_id):
     if song_id in session['voted_songs']:
         return jsonify({'success': False, 'message': '您已经投过票了'})
     
-    today_list = get_daily_list()
-    song_found = False
-    
-    for song in today_list:
-        if song['id'] == song_id:
-            song['votes'] = song.get('votes', 0) + 1
-            song_found = True
-            break
+    votes = storage.vote(get_today_date_str(), song_id)
     
-    if song_found and save_daily_list(today_list):
+    if votes is not None:
         # 记录用户已投票
         session['voted_songs'].append(song_id)
         session.modified = True
-        return jsonify({'success': True, 'votes': song['votes']})
+        return jsonify({'success': True, 'votes': votes})
     else:
         return jsonify({'success': False, 'message': '投票失败'})
         
 # 在 app.py 中找到 search_songs 函数并替换为以下代码
 
+# 搜索结果缓存：按规范化后的关键词缓存，“未找到”的结果也短时间缓存
+app.config['SEARCH_CACHE_SIZE'] = 1000  # 最多缓存的关键词数
+app.config['SEARCH_CACHE_TTL'] = 30 * 60  # 搜索结果缓存时间（秒）
+app.config['SEARCH_NEGATIVE_TTL'] = 2 * 60  # 未找到结果的缓存时间（秒）
+search_cache = TTLCache('search', max_size=app.config['SEARCH_CACHE_SIZE'],
+                        ttl=app.config['SEARCH_CACHE_TTL'],
+                        negative_ttl=app.config['SEARCH_NEGATIVE_TTL'],
+                        fallback_errors=UPSTREAM_FALLBACK_ERRORS)
+
+def normalize_search_keyword(keyword):
+    """规范化搜索关键词：全角转半角、合并空白、忽略大小写"""
+    keyword = unicodedata.normalize('NFKC', keyword)
+    return ' '.join(keyword.split()).lower()
+
+def fetch_search_results(keyword):
+    """请求上游搜索接口，未找到时返回空列表"""
+    params = {
+        'keyword': keyword,
+        'limit': 10
+    }
+    
+    response = upstream.get(
+        'https://api.zh-mc.top/Search', 
+        params=params,
+        timeout=10
+    )
+    response.raise_for_status()
+    
+    song_data = response.json()
+    if song_data.get('success') and song_data.get('data'):
+        return song_data['data']
+    return []
+
 @app.route('/search_songs', methods=['POST'])
 def search_songs():
     """搜索歌曲API"""
@@ -559,29 +785,27 @@ def search_songs():
         return jsonify({'success': False, 'message': '请输入歌曲名称'})
     
     try:
-        params = {
-            'keyword': song_name,
-            'limit': 10
-        }
-        
-        response = requests.get(
-            'https://api.zh-mc.top/Search', 
-            params=params,
-            timeout=10
-        )
-        response.raise_for_status()
+        # 相同关键词命中缓存；同时到达的相同搜索只请求一次上游
+        keyword = normalize_search_keyword(song_name)
+        songs = search_cache.get_or_load(keyword, lambda: fetch_search_results(keyword))
         
-        song_data = response.json()
-        if song_data.get('success') and song_data.get('data'):
+        if songs:
             return jsonify({
                 'success': True, 
-                'songs': song_data['data']
+                'songs': songs
             })
         else:
             return jsonify({
                 'success': False, 
                 'message': '未找到相关歌曲'
             })
+    except (RateLimited, CircuitOpen) as e:
+        response = jsonify({
+            'success': False,
+            'message': '搜索的人太多了，请稍后再试' if isinstance(e, RateLimited) else '音乐服务暂时不可用，请稍后再试'
+        })
+        response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+        return response, 429
     except Exception as e:
         app.logger.error(f"搜索歌曲时发生错误: {str(e)}")
         return jsonify({
@@ -601,6 +825,36 @@ def api_daily_stats():
         'max': MAX_DAILY_REQUESTS
     })
 
+@app.route('/api/song_url/<int:request_id>')
+def api_song_url(request_id):
+    """
+    按需获取今日列表中某首歌曲的播放地址
+    播放器播放该歌曲时以 redirect=1 调用（直接跳转到音频地址），
+    预加载下一首时以JSON方式调用，提前把上游链接放进缓存
+    音质由 level 参数决定，未指定时使用试听音质
+    """
+    song = next((item for item in get_daily_list() if item['id'] == request_id), None)
+    if song is None:
+        return jsonify({'success': False, 'message': '歌曲不存在'}), 404
+    
+    level = pick_audio_level(app.config['PREVIEW_LEVEL'])
+    try:
+        url, source = resolve_play_url(song, level)
+    except (RateLimited, CircuitOpen) as e:
+        response = jsonify({'success': False, 'message': '请求过多或音乐服务暂时不可用，请稍后再试'})
+        response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+        return response, 429
+    except Exception as e:
+        app.logger.error(f"获取歌曲URL失败: {str(e)}")
+        url, source = '', 'error'
+    
+    if request.args.get('redirect'):
+        if not url:
+            return "无法获取播放地址", 404
+        return redirect(url)
+    
+    return jsonify({'success': bool(url), 'url': url, 'source': source, 'level': level})
+
 def delete_song_request(request_id):
     """从当天列表中删除歌曲请求"""
     # 验证ID是否为整数
@@ -609,22 +863,15 @@ def delete_song_request(request_id):
     except (ValueError, TypeError):
         return False
     
-    today_list = get_daily_list()
-    today_list = [item for item in today_list if item['id'] != request_id]
-    return save_daily_list(today_list)
+    return storage.delete(get_today_date_str(), [request_id]) is not None
 
 def get_available_dates():
     """获取所有可用的日期列表（按日期倒序）"""
-    files = os.listdir(app.config['DATA_DIR'])
-    dates = []
-    for f in files:
-        if f.endswith('.json') and not f.endswith('admin_accounts.json'):
-            date_str = f.replace('.json', '')
-            if validate_date_string(date_str):
-                dates.append(date_str)
-    return sorted(dates, reverse=True)[:100]  # 只保留最近100天
+    return storage.list_dates()[:100]  # 只保留最近100天
 
 # 管理员账户管理
+state_store.register('admin_accounts', app.config['ADMIN_ACCOUNTS_FILE'], [])
+
 def get_admin_accounts():
     """获取管理员账户信息"""
     accounts_file = app.config['ADMIN_ACCOUNTS_FILE']
@@ -632,13 +879,7 @@ def get_admin_accounts():
     if not os.path.abspath(accounts_file).startswith(os.path.abspath(app.config['DATA_DIR'])):
         return []
     
-    if os.path.exists(accounts_file):
-        try:
-            with open(accounts_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    return state_store.get('admin_accounts')
 
 def save_admin_accounts(accounts):
     """保存管理员账户信息"""
@@ -647,12 +888,7 @@ def save_admin_accounts(accounts):
     if not os.path.abspath(accounts_file).startswith(os.path.abspath(app.config['DATA_DIR'])):
         return False
     
-    try:
-        with open(accounts_file, 'w', encoding='utf-8') as f:
-            json.dump(accounts, f, ensure_ascii=False, indent=2)
-        return True
-    except:
-        return False
+    return state_store.set('admin_accounts', accounts)
 
 def init_admin_account():
     """初始化管理员账户（如果不存在）"""
@@ -737,6 +973,9 @@ def control_required(f):
             'admin',  # 主页（播放功能）
             'serve_download_file',  # 下载文件
             'download_songs',  # 下载歌曲包
+            'download_songs_status',  # 歌曲包打包进度
+            'download_songs_stream',  # 流式下载歌曲包
+            'admin_prefetch_report',  # 预取就绪报告
             'export_requests',  # 导出Excel
             'admin_logout'  # 登出
         ]
@@ -767,52 +1006,6 @@ def format_datetime_filter(value):
     except (ValueError, TypeError):
         return value
         
-def init_scheduler():
-    scheduler = BackgroundScheduler()
-    
-    # 设置每天中午12:30执行的任务 - 重置当天歌曲列表
-    @scheduler.scheduled_job(CronTrigger(hour=12, minute=30))
-    def reset_daily_list():
-        # 创建今天的空列表文件
-        today_filename = get_today_filename(True)
-        if not os.path.exists(today_filename):
-            save_daily_list([])
-            print(f"Created new daily list for {date.today()}")
-    
-    # 设置每天下午18:00执行的任务 - 清理旧数据
-    @scheduler.scheduled_job(CronTrigger(hour=18, minute=0))
-    def cleanup_old_data():
-        # 清理100天前的旧数据
-        keep_days = 100
-        cutoff_date = date.today() - timedelta(days=keep_days)
-        
-        for filename in os.listdir(app.config['DATA_DIR']):
-            if filename.endswith('.json') and not filename.endswith('admin_accounts.json'):
-                try:
-                    file_date = datetime.strptime(filename.replace('.json', ''), '%Y-%m-%d').date()
-                    if file_date < cutoff_date:
-                        file_path = os.path.join(app.config['DATA_DIR'], filename)
-                        # 确保文件路径在数据目录内
-                        if os.path.abspath(file_path).startswith(os.path.abspath(app.config['DATA_DIR'])):
-                            os.remove(file_path)
-                            print(f"Removed old file: {filename}")
-                except ValueError:
-                    continue  # 跳过格式不正确的文件名
-    
-
-    @scheduler.scheduled_job(CronTrigger(hour=2, minute=0))
-    def cleanup_download_files():
-        """清理下载的歌曲文件"""
-        try:
-            if os.path.exists(app.config['SONG_DOWNLOAD_DIR']):
-                shutil.rmtree(app.config['SONG_DOWNLOAD_DIR'])
-                os.makedirs(app.config['SONG_DOWNLOAD_DIR'], exist_ok=True)
-                print("已清理下载的歌曲文件")
-        except Exception as e:
-            print(f"清理下载文件时出错: {str(e)}")
-    
-    scheduler.start()
-
 # 修改 / 路由函数，确保在审核前所有歌曲都显示
 @app.route('/')
 def index():
@@ -831,53 +1024,8 @@ def index():
     # 按投票数从高到低排序
     display_songs_sorted = sorted(display_songs, key=lambda x: x.get('votes', 0), reverse=True)
     
-    # 为每个歌曲添加播放URL
-    for request in display_songs_sorted:
-        # 如果本地有下载的文件，使用本地文件
-        song_name = request.get('song_name', '')
-        
-        def sanitize_filename(name):
-            illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-            for char in illegal_chars:
-                name = name.replace(char, '_')
-            name = ''.join(char for char in name if ord(char) >= 32)
-            if len(name) > 100:
-                name = name[:100]
-            return name.strip()
-        
-        filename_title = song_name
-        expected_filename = f"{sanitize_filename(filename_title)}.mp3"
-        expected_filepath = os.path.join(app.config['SONG_DOWNLOAD_DIR'], expected_filename)
-        
-        # 检查本地文件是否存在
-        if os.path.exists(expected_filepath):
-            request['url'] = f"/data/downloads/{expected_filename}"
-        else:
-            # 如果没有本地文件，但有song_id，则获取在线URL
-            song_id = request.get('song_id')
-            if song_id:
-                try:
-                    params = {
-                        'url': song_id,
-                        'level': 'standard',
-                        'type': 'json'
-                    }
-                    response = requests.get(
-                        'https://api.zh-mc.top/Song_V1',
-                        params=params,
-                        timeout=10
-                    )
-                    response.raise_for_status()
-                    song_data = response.json()
-                    if song_data.get('success') and song_data.get('data'):
-                        request['url'] = song_data['data'].get('url', '')
-                    else:
-                        request['url'] = ''
-                except Exception as e:
-                    app.logger.error(f"获取歌曲URL失败: {str(e)}")
-                    request['url'] = ''
-            else:
-                request['url'] = ''
+    # 为每个歌曲添加播放URL（本地文件优先，其余并发解析）
+    add_song_urls_to_requests(display_songs_sorted, level=pick_audio_level(app.config['PREVIEW_LEVEL']))
     
     return render_template('index.html', 
                           form=form, 
@@ -889,6 +1037,121 @@ def index():
                           system_status=system_status,)
 
 
+# 播放前预取：在网络空闲时把点歌列表中的歌曲（按票数从高到低）下载到本地缓存并刷新歌词
+app.config['PREFETCH_HOUR'] = 5  # 每天预取的时间
+app.config['PREFETCH_MINUTE'] = 0
+state_store.register('prefetch_report', os.path.join(app.config['DATA_DIR'], 'prefetch_report.json'), {})
+app.config['PREFETCH_LOCK_FILE'] = os.path.join(app.config['DATA_DIR'], 'prefetch.lock')
+_prefetch_fallback_lock = threading.Lock()  # 没有 fcntl 时的进程内锁
+
+def _try_prefetch_lock():
+    """
+    不等待地获取预取锁，成功时返回释放函数，已有预取在进行时返回 None
+    flock 在所有 worker 进程之间互斥，同一份列表不会被多个进程同时预取
+    """
+    if fcntl is None:
+        if not _prefetch_fallback_lock.acquire(blocking=False):
+            return None
+        return _prefetch_fallback_lock.release
+    lock_file = open(app.config['PREFETCH_LOCK_FILE'], 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    # 关闭文件即释放锁
+    return lock_file.close
+
+def _prefetch_song(song, date_str):
+    """预取 date_str 列表中的单首歌曲，返回 (文件路径, 消息, 是否有歌词)"""
+    song_id = song.get('song_id')
+    if not song_id:
+        return None, "缺少歌曲ID", False
+    level = app.config['BROADCAST_LEVEL']
+    with upstream.priority('background'):
+        try:
+            # 按广播音质重新请求歌词：同一次 Song_V1 请求也缓存了下载链接，下载时不再重复请求
+            lyric = get_song_lyric(song_id, level, refresh=True)
+        except Exception:
+            lyric = None
+        song_filepath, message, download_lyric = download_single_song(song_id, song['song_name'],
+                                                                      song.get('artist', ''), level=level)
+    if lyric is None:
+        # 上游不可用时保留旧歌词
+        lyric = download_lyric or song.get('lyric') or ''
+    # 播放页优先使用点歌记录中的歌词，一并更新
+    if lyric and lyric != song.get('lyric') and song.get('id') is not None:
+        storage.set_lyric(date_str, song['id'], lyric)
+    return song_filepath, message, bool(lyric)
+
+def prefetch_daily_list(date_str=None):
+    """
+    预取指定日期（默认为当前列表）的全部歌曲，并把就绪报告写入 prefetch_report
+    已有预取在进行时直接返回 None
+    """
+    release = _try_prefetch_lock()
+    if release is None:
+        return None
+    try:
+        date_str = date_str or get_today_date_str()
+        songs = sorted(get_daily_list(date_str), key=lambda x: x.get('votes', 0), reverse=True)
+        report = {
+            'date': date_str,
+            'status': 'running',
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'finished_at': None,
+            'total': len(songs),
+            'ready': 0,
+            'failed': 0,
+            'items': []
+        }
+        state_store.set('prefetch_report', report)
+        
+        # 按票数顺序提交，票数高的歌曲先下载
+        with ThreadPoolExecutor(max_workers=app.config['MAX_CONCURRENT_DOWNLOADS'],
+                                thread_name_prefix='prefetch') as pool:
+            results = list(pool.map(lambda song: _prefetch_song(song, date_str), songs))
+        
+        for song, (song_filepath, message, has_lyric) in zip(songs, results):
+            report['items'].append({
+                'id': song.get('id'),
+                'song_name': song['song_name'],
+                'votes': song.get('votes', 0),
+                'ready': bool(song_filepath),
+                'lyric': has_lyric,
+                'message': message
+            })
+            if song_filepath:
+                report['ready'] += 1
+            else:
+                report['failed'] += 1
+        report['status'] = 'done'
+        report['finished_at'] = datetime.now().isoformat(timespec='seconds')
+        state_store.set('prefetch_report', report)
+        print(f"预取完成 {date_str}: 就绪 {report['ready']}/{report['total']} 首")
+        return report
+    finally:
+        release()
+
+@app.route('/admin/prefetch', methods=['POST'])
+@admin_required
+def admin_prefetch():
+    """手动开始预取当前点歌列表"""
+    release = _try_prefetch_lock()
+    if release is None:
+        flash('预取正在进行中，请稍后查看结果', 'info')
+    else:
+        release()
+        threading.Thread(target=prefetch_daily_list, name='prefetch', daemon=True).start()
+        flash('已开始预取歌曲，完成后可在管理页面查看就绪情况', 'success')
+    return redirect(url_for('admin'))
+
+@app.route('/admin/prefetch/report')
+@control_required
+def admin_prefetch_report():
+    """预取就绪报告"""
+    return jsonify(state_store.get('prefetch_report'))
+
 def init_scheduler():
     scheduler = BackgroundScheduler()
     
@@ -896,10 +1159,10 @@ def init_scheduler():
     @scheduler.scheduled_job(CronTrigger(hour=12, minute=30))
     def reset_daily_list():
         # 创建今天的空列表文件
-        today_filename = get_today_filename(True)
-        if not os.path.exists(today_filename):
+        today_str = get_today_date_str()
+        if not storage.exists(today_str):
             save_daily_list([])
-            print(f"Created new daily list for {date.today()}")
+            print(f"Created new daily list for {today_str}")
     
     # 设置每天下午18:00执行的任务 - 清理旧数据
     @scheduler.scheduled_job(CronTrigger(hour=18, minute=0))
@@ -908,30 +1171,35 @@ def init_scheduler():
         keep_days = 100
         cutoff_date = date.today() - timedelta(days=keep_days)
         
-        for filename in os.listdir(app.config['DATA_DIR']):
-            if filename.endswith('.json') and not filename.endswith('admin_accounts.json') and not filename.endswith('review_status.json'):
-                try:
-                    file_date = datetime.strptime(filename.replace('.json', ''), '%Y-%m-%d').date()
-                    if file_date < cutoff_date:
-                        file_path = os.path.join(app.config['DATA_DIR'], filename)
-                        # 确保文件路径在数据目录内
-                        if os.path.abspath(file_path).startswith(os.path.abspath(app.config['DATA_DIR'])):
-                            os.remove(file_path)
-                            print(f"Removed old file: {filename}")
-                except ValueError:
-                    continue  # 跳过格式不正确的文件名
-    
-    # 添加每日清理下载文件的任务（凌晨2点执行）
-    @scheduler.scheduled_job(CronTrigger(hour=2, minute=0))
-    def cleanup_download_files():
-        """清理下载的歌曲文件"""
+        for date_str in storage.list_dates():
+            file_date = datetime.strptime(date_str, '%Y-%m-%d').date()
+            if file_date < cutoff_date:
+                storage.remove_list(date_str)
+                print(f"Removed old list: {date_str}")
+    
+    # 定期把操作日志合并回每日JSON快照（journal后端），sqlite后端则写回WAL检查点
+    @scheduler.scheduled_job(IntervalTrigger(minutes=app.config['STORAGE_COMPACT_INTERVAL']))
+    def compact_storage():
+        try:
+            storage.compact()
+        except Exception as e:
+            print(f"合并点歌数据时出错: {str(e)}")
+    
+    # 定期维护本地歌曲缓存：写回访问记录、清理无效文件、按容量淘汰
+    @scheduler.scheduled_job(IntervalTrigger(minutes=app.config['AUDIO_CACHE_MAINTAIN_INTERVAL']))
+    def maintain_audio_cache():
         try:
-            if os.path.exists(app.config['SONG_DOWNLOAD_DIR']):
-                shutil.rmtree(app.config['SONG_DOWNLOAD_DIR'])
-                os.makedirs(app.config['SONG_DOWNLOAD_DIR'], exist_ok=True)
-                print("已清理下载的歌曲文件")
+            audio_cache.flush()
         except Exception as e:
-            print(f"清理下载文件时出错: {str(e)}")
+            print(f"维护歌曲缓存时出错: {str(e)}")
+    
+    # 每天在网络空闲时预取当前列表的歌曲
+    @scheduler.scheduled_job(CronTrigger(hour=app.config['PREFETCH_HOUR'], minute=app.config['PREFETCH_MINUTE']))
+    def prefetch_songs():
+        try:
+            prefetch_daily_list()
+        except Exception as e:
+            print(f"预取歌曲时出错: {str(e)}")
     
     scheduler.start()
 
@@ -943,6 +1211,8 @@ def get_classes(grade):
     return jsonify([])
     
 # 在 app.py 中添加读取更新日志的函数
+state_store.register('changelog', os.path.join(app.config['DATA_DIR'], 'changelog.json'), [])
+
 def get_changelog():
     """获取更新日志内容"""
     changelog_file = os.path.join(app.config['DATA_DIR'], 'changelog.json')
@@ -950,13 +1220,7 @@ def get_changelog():
     if not os.path.abspath(changelog_file).startswith(os.path.abspath(app.config['DATA_DIR'])):
         return []
     
-    if os.path.exists(changelog_file):
-        try:
-            with open(changelog_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+    return state_store.get('changelog')
 
 # 修改更新日志路由
 @app.route('/changelog')
@@ -989,22 +1253,7 @@ def submit_request():
         lyric = None
         if song_id:
             try:
-                params = {
-                    'url': song_id,
-                    'level': 'standard',
-                    'type': 'json'
-                }
-                
-                response = requests.get(
-                    'https://api.zh-mc.top/Song_V1',
-                    params=params,
-                    timeout=10
-                )
-                response.raise_for_status()
-                
-                song_data = response.json()
-                if song_data.get('success') and song_data.get('data'):
-                    lyric = song_data['data'].get('lyric', '')
+                lyric = get_song_lyric(song_id)
             except Exception as e:
                 app.logger.error(f"获取歌词时发生错误: {str(e)}")
         
@@ -1021,29 +1270,20 @@ def submit_request():
         
         if success:
             flash(message, 'success')
-            # 如果有歌曲ID，准备下载信息并触发下载
+            # 如果有歌曲ID，加入后台下载队列，下载进度通过 /api/download_status 查询
             if song_id:
-                # 直接在后台下载歌曲
-                download_file_path, download_message, _ = download_single_song(
-                    song_id, 
-                    form.song_name.data, 
-                    artists if artists else ''
-                )
-                
-                # 将下载链接存储在session中，供前端获取
-                if download_file_path:
-                    filename = os.path.basename(download_file_path)
-                    session['download_url'] = url_for('download_song_file', filename=filename)
-                else:
-                    flash(f'歌曲下载失败: {download_message}', 'warning')
-            
+                try:
+                    download_queue.enqueue(song_id, form.song_name.data, artists if artists else '')
+                except Exception as e:
+                    app.logger.error(f"加入下载队列失败: {str(e)}")
+
             return redirect(url_for('index'))
         else:
             flash(message, 'danger')
             # 获取今日歌曲列表并按投票数排序，确保模板变量完整
             today_requests = get_daily_list()
             today_requests_sorted = sorted(today_requests, key=lambda x: x.get('votes', 0), reverse=True)
-            today_requests_sorted = add_song_urls_to_requests(today_requests_sorted)
+            today_requests_sorted = add_song_urls_to_requests(today_requests_sorted, level=pick_audio_level(app.config['PREVIEW_LEVEL']))
             
             return render_template('index.html', 
                                 form=form, 
@@ -1062,7 +1302,7 @@ def submit_request():
     # 获取今日歌曲列表并按投票数排序，确保模板变量完整
     today_requests = get_daily_list()
     today_requests_sorted = sorted(today_requests, key=lambda x: x.get('votes', 0), reverse=True)
-    today_requests_sorted = add_song_urls_to_requests(today_requests_sorted)
+    today_requests_sorted = add_song_urls_to_requests(today_requests_sorted, level=pick_audio_level(app.config['PREVIEW_LEVEL']))
     
     return render_template('index.html',
                           form=form,
@@ -1125,22 +1365,11 @@ def serve_download_file(filename):
         # 确保只取文件名部分，防止路径遍历
         filename = os.path.basename(filename)
         
-        # 构建文件路径
-        file_path = os.path.join(app.config['SONG_DOWNLOAD_DIR'], filename)
-        
-        # 检查文件是否存在
-        if not os.path.exists(file_path):
-            app.logger.error(f"文件不存在: {file_path}")
-            # 列出目录中的所有文件以帮助调试
-            if os.path.exists(app.config['SONG_DOWNLOAD_DIR']):
-                files = os.listdir(app.config['SONG_DOWNLOAD_DIR'])
-                app.logger.error(f"目录中的文件: {files}")
+        response = send_audio_file(filename)
+        if response is None:
+            app.logger.warning(f"文件不存在: {filename}")
             return "文件不存在", 404
-            
-        return send_file(
-            file_path,
-            mimetype='audio/mpeg'
-        )
+        return response
     except Exception as e:
         app.logger.error(f"提供下载文件时出错: {str(e)}")
         return "文件访问失败", 500
@@ -1156,70 +1385,19 @@ def admin():
     # 获取当前用户角色
     current_user_role = session.get('admin_role', 'admin')
     
-    # 为每个歌曲添加本地MP3文件的URL
-    for request in today_requests_sorted:
-        song_name = request.get('song_name', '')
-        # 清理文件名中的非法字符
-        def sanitize_filename(name):
-            """统一的文件名清理函数"""
-            # 移除或替换非法字符
-            illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-            for char in illegal_chars:
-                name = name.replace(char, '_')
-            
-            # 移除控制字符
-            name = ''.join(char for char in name if ord(char) >= 32)
-            
-            # 限制长度
-            if len(name) > 100:
-                name = name[:100]
-            
-            return name.strip()
-        
-        # 构造可能已存在的文件名
-        filename_title = song_name
-        expected_filename = f"{sanitize_filename(filename_title)}.mp3"
-        expected_filepath = os.path.join(app.config['SONG_DOWNLOAD_DIR'], expected_filename)
-        
-        # 检查文件是否存在，如果存在则添加URL
-        if os.path.exists(expected_filepath):
-            # 直接使用相对路径，避免URL编码问题
-            request['url'] = f"/data/downloads/{expected_filename}"
-        else:
-            # 如果本地文件不存在，但有song_id，则尝试获取在线URL
-            song_id = request.get('song_id')
-            if song_id:
-                try:
-                    params = {
-                        'url': song_id,
-                        'level': 'standard',
-                        'type': 'json'
-                    }
-                    response = requests.get(
-                        'https://api.zh-mc.top/Song_V1',
-                        params=params,
-                        timeout=10
-                    )
-                    response.raise_for_status()
-                    song_data = response.json()
-                    if song_data.get('success') and song_data.get('data'):
-                        request['url'] = song_data['data'].get('url', '')
-                        # 同时获取歌词
-                        request['lyric'] = song_data['data'].get('lyric', '')
-                    else:
-                        request['url'] = ''
-                        request['lyric'] = ''
-                except Exception as e:
-                    app.logger.error(f"获取歌曲URL失败: {str(e)}")
-                    request['url'] = ''
-                    request['lyric'] = ''
-            else:
-                request['url'] = ''
-                request['lyric'] = ''
+    # 为每个歌曲添加广播音质的播放URL和歌词（本地文件优先，其余按需解析）
+    add_song_urls_to_requests(today_requests_sorted, with_lyric=True,
+                              level=pick_audio_level(app.config['BROADCAST_LEVEL'], save_data=False))
+    
+    # 当前列表的预取就绪情况
+    prefetch_report = state_store.get('prefetch_report')
+    if prefetch_report.get('date') != get_today_date_str():
+        prefetch_report = None
     
     return render_template('admin.html', 
                           today_requests=today_requests_sorted,
                           system_status=system_status,
+                          prefetch_report=prefetch_report,
                           user_role=current_user_role)  # 传递用户角色到模板
 # 批量删除歌曲请求
 @app.route('/admin/batch_delete', methods=['POST'])
@@ -1241,15 +1419,11 @@ def batch_delete():
         # 转换为整数ID
         selected_ids = [int(song_id) for song_id in selected_songs]
         
-        # 获取当前歌曲列表
-        today_list = get_daily_list()
+        # 在一个操作内删除被选中的歌曲
+        deleted_count = storage.delete(get_today_date_str(), selected_ids)
         
-        # 过滤掉被选中的歌曲
-        filtered_list = [song for song in today_list if song['id'] not in selected_ids]
-        
-        # 保存更新后的列表
-        if save_daily_list(filtered_list):
-            flash(f'成功删除 {len(today_list) - len(filtered_list)} 首歌曲', 'success')
+        if deleted_count is not None:
+            flash(f'成功删除 {deleted_count} 首歌曲', 'success')
         else:
             flash('删除失败，请稍后再试', 'danger')
             
@@ -1329,16 +1503,29 @@ def export_requests():
 
 # 在 app.py 中添加自动审核相关函数和路由
 
-def auto_review_songs(songs_list):
-    """
-    使用 DeepSeek API 自动审核歌曲列表
-    """
-    try:
-        # 将歌曲列表转换为 JSON 字符串
-        songs_json = json.dumps(songs_list, ensure_ascii=False, indent=2)
-        
-        # 构建提示词
-        prompt = f"""
+# 自动审核使用的模型和提示词版本；修改审核规则后把版本号加一，已保存的结论随之失效
+app.config['REVIEW_MODEL'] = 'deepseek-chat'
+app.config['REVIEW_PROMPT_VERSION'] = 1
+app.config['REVIEW_VERDICTS_FILE'] = os.path.join(app.config['DATA_DIR'], 'review_verdicts.json')  # 每首歌的审核结论
+app.config['REVIEW_VERDICT_MAX_AGE_DAYS'] = None  # 结论有效天数，None 表示一直有效
+
+review_verdicts = VerdictStore(
+    app.config['REVIEW_VERDICTS_FILE'],
+    max_age_days=app.config['REVIEW_VERDICT_MAX_AGE_DAYS'],
+)
+
+# 审核分批并发进行，每批只发送审核需要的字段
+app.config['REVIEW_BATCH_SIZE'] = 20  # 每批发送给 AI 的歌曲数
+app.config['REVIEW_WORKERS'] = 4  # 同时审核的批次数
+app.config['REVIEW_BATCH_RETRIES'] = 2  # 单批失败后的重试次数
+app.config['REVIEW_LYRIC_CHARS'] = 200  # 附带的歌词片段长度，0 表示不发送歌词
+app.config['REVIEW_TIMEOUT'] = 60  # 单批请求超时（秒）
+app.config['REVIEW_STREAM'] = True  # 流式接收 AI 输出，每解析出一条结果立即推送到管理页面
+
+def build_review_prompt(batch):
+    """构建一批歌曲的审核提示词"""
+    songs_json = json.dumps(batch, ensure_ascii=False)
+    return f"""
 你是一个校园点歌台的审核员
 请根据以下规则，对以下歌曲进行审核：
 
@@ -1356,9 +1543,10 @@ def auto_review_songs(songs_list):
 歌曲列表：
 {songs_json}
 
-请按以下格式输出审核结果：
+请按以下格式输出审核结果，每首歌曲一项，编号与歌曲列表中的编号一致：
 [
   {{
+    "编号": 1,
     "歌曲名称": "歌曲名",
     "是否通过": true/false,
     "原因": "通过原因或拒绝理由"
@@ -1368,56 +1556,124 @@ def auto_review_songs(songs_list):
 
 请只输出JSON结果，不要包含其他内容。
 """
-        
-        # 初始化 DeepSeek 客户端
-        client = OpenAI(
-            api_key=app.config['DEEPSEEK_API_KEY'],
-            base_url="https://api.deepseek.com/v1"
-        )
-        
-        # 调用 API 进行审核
-        response = client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[
-                {"role": "system", "content": "你是一个严格的校园点歌台审核员，负责审核学生点播的歌曲是否适合在校园播放。"},
-                {"role": "user", "content": prompt}
-            ],
-            stream=False,
-            temperature=0.3  # 降低随机性，使结果更稳定
-        )
-        
-        # 获取审核结果
-        review_result = response.choices[0].message.content
-        
-        # 尝试解析 JSON 结果
-        print(review_result)
-        
-        # 提取JSON部分（去除可能的代码块标记）
-        if review_result.startswith("```json"):
-            review_result = review_result[7:]  # 移除开头的 ```json
-        if review_result.endswith("```"):
-            review_result = review_result[:-3]  # 移除结尾的 ```
-        
-        # 解析JSON
-        result_json = json.loads(review_result)
-        return result_json
-            
-    except json.JSONDecodeError as e:
-        app.logger.error(f"JSON解析错误: {e}")
-        app.logger.error(f"原始响应内容: {review_result}")
-        return None
-    except Exception as e:
-        app.logger.error(f"调用DeepSeek API时出错: {e}")
-        return None
 
-# 添加全局变量存储最近一次的审核结果
-recent_review_results = []
+def review_batch(client, batch, on_item):
+    """
+    调用 DeepSeek 审核一批歌曲，返回解析后的结果列表
+    流式模式下每解析出一条完整结果就调用 on_item(结果)
+    """
+    stream = app.config['REVIEW_STREAM']
+    response = client.chat.completions.create(
+        model=app.config['REVIEW_MODEL'],
+        messages=[
+            {"role": "system", "content": "你是一个严格的校园点歌台审核员，负责审核学生点播的歌曲是否适合在校园播放。"},
+            {"role": "user", "content": build_review_prompt(batch)}
+        ],
+        stream=stream,
+        temperature=0.3  # 降低随机性，使结果更稳定
+    )
+    if not stream:
+        return parse_review_json(response.choices[0].message.content)
+    
+    parser = JsonArrayParser()
+    results = []
+    for chunk in response:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        for item in parser.feed(chunk.choices[0].delta.content):
+            on_item(item)
+            results.append(item)
+    return results
+
+def auto_review_songs(songs_list, on_result=None, on_batch=None):
+    """
+    使用 DeepSeek API 自动审核歌曲列表
+    返回与 songs_list 等长的列表，每项为 (是否通过, 原因)，审核失败的歌曲为 None
+    on_result(songs_list中的下标, (是否通过, 原因)) 在每首歌得到结论时调用，
+    on_batch({下标: (是否通过, 原因)}) 在每批结束时调用一次
+    """
+    # 初始化 DeepSeek 客户端（失败重试由 review_in_batches 按批次进行）
+    client = OpenAI(
+        api_key=app.config['DEEPSEEK_API_KEY'],
+        base_url="https://api.deepseek.com/v1",
+        timeout=app.config['REVIEW_TIMEOUT'],
+        max_retries=0
+    )
+    return review_in_batches(
+        songs_list,
+        lambda batch, on_item: review_batch(client, batch, on_item),
+        batch_size=app.config['REVIEW_BATCH_SIZE'],
+        workers=app.config['REVIEW_WORKERS'],
+        retries=app.config['REVIEW_BATCH_RETRIES'],
+        lyric_chars=app.config['REVIEW_LYRIC_CHARS'],
+        on_result=on_result,
+        on_batch=on_batch,
+    )
+
+# 自动审核前的本地预审名单（每行一个词，按包含匹配），由管理员在 /admin/review_rules 维护
+app.config['REVIEW_RULES_FILE'] = os.path.join(app.config['DATA_DIR'], 'review_rules.json')
+app.config['REVIEW_TITLE_KANA'] = 2  # 歌名中达到该数量的日文假名判定为日语歌曲
+app.config['REVIEW_LYRIC_KANA'] = 20  # 歌词中达到该数量的日文假名判定为日语歌曲
+
+REVIEW_RULE_LISTS = ('block_titles', 'block_artists', 'allow_titles', 'allow_artists')
+state_store.register('review_rules', app.config['REVIEW_RULES_FILE'],
+                     {name: [] for name in REVIEW_RULE_LISTS})
+
+def get_prescreen():
+    """按当前名单构建本地预审"""
+    rules = state_store.get('review_rules')
+    return PreScreen(
+        title_kana=app.config['REVIEW_TITLE_KANA'],
+        lyric_kana=app.config['REVIEW_LYRIC_KANA'],
+        **{name: rules.get(name, []) for name in REVIEW_RULE_LISTS}
+    )
+
+def run_review(songs, on_result):
+    """
+    审核任务：本地预审能判断的歌曲直接给出结论，已有有效结论的歌曲使用已有结论，
+    其余歌曲分批发送给 AI
+    """
+    model = app.config['REVIEW_MODEL']
+    prompt_version = app.config['REVIEW_PROMPT_VERSION']
+    prescreen = get_prescreen()
+    pending = []
+    for index, song in enumerate(songs):
+        # 预审结论不保存，名单修改后立即生效
+        verdict = prescreen.check(song)
+        if verdict:
+            on_result(index, verdict[0], verdict[1], 'rule')
+            continue
+        cached = review_verdicts.lookup(song, model, prompt_version)
+        if cached:
+            on_result(index, cached['passed'], cached['reason'], 'cache')
+        else:
+            pending.append(index)
+    if not pending:
+        return
+    
+    def on_ai_result(i, verdict):
+        on_result(pending[i], verdict[0], verdict[1], 'ai')
+    
+    def on_ai_batch(verdicts):
+        # 每批结束时保存这一批的结论，任务中途失败时已审核的批次不必重新审核
+        review_verdicts.record([(songs[pending[i]], passed, reason) for i, (passed, reason) in verdicts.items()],
+                               model, prompt_version)
+    
+    auto_review_songs([songs[i] for i in pending], on_result=on_ai_result, on_batch=on_ai_batch)
+
+# 审核在后台任务中进行，结果按日期保存，任何 worker 进程都可以查询和应用
+app.config['REVIEW_JOBS_DIR'] = os.path.join(app.config['DATA_DIR'], 'review_jobs')
+app.config['REVIEW_JOBS_KEEP_DAYS'] = 7  # 审核任务记录保留天数
+app.config['REVIEW_EVENT_INTERVAL'] = 0.5  # SSE 推送检查任务进度的间隔（秒）
+
+review_jobs = ReviewJobManager(app.config['REVIEW_JOBS_DIR'], run_review,
+                               keep_days=app.config['REVIEW_JOBS_KEEP_DAYS'])
 
 @app.route('/admin/auto_review', methods=['POST'])
 @admin_required
 def admin_auto_review():
     """
-    自动审核歌曲列表
+    创建自动审核任务，进度通过 status_url 轮询或 events_url（SSE）获取
     """
     try:
         # 获取今日歌曲列表
@@ -1429,22 +1685,13 @@ def admin_auto_review():
                 'message': '今日无点歌记录'
             }), 400
         
-        # 调用自动审核函数
-        review_results = auto_review_songs(today_requests)
-        
-        if review_results is None:
-            return jsonify({
-                'status': 'error',
-                'message': '审核失败，请稍后重试'
-            }), 500
-        
-        # 存储审核结果以便后续应用
-        global recent_review_results
-        recent_review_results = review_results
-        
+        job_id = review_jobs.start(get_today_date_str(), today_requests)
         return jsonify({
-            'status': 'success',
-            'results': review_results
+            'status': 'started',
+            'job_id': job_id,
+            'total': len(today_requests),
+            'status_url': url_for('admin_review_status', job_id=job_id),
+            'events_url': url_for('admin_review_events', job_id=job_id)
         })
         
     except Exception as e:
@@ -1454,79 +1701,121 @@ def admin_auto_review():
             'message': str(e)
         }), 500
 
+@app.route('/admin/auto_review/<job_id>')
+@admin_required
+def admin_review_status(job_id):
+    """查询审核任务的进度和结果"""
+    job = review_jobs.status(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': '审核任务不存在或已过期'}), 404
+    return jsonify(job)
+
+@app.route('/admin/auto_review/<job_id>/events')
+@admin_required
+def admin_review_events(job_id):
+    """
+    以 Server-Sent Events 推送审核结果：每首歌得到结论时发送 result 事件，
+    任务结束时发送 done 事件
+    """
+    if review_jobs.status(job_id) is None:
+        return jsonify({'status': 'error', 'message': '审核任务不存在或已过期'}), 404
+    
+    def events():
+        sent = set()
+        idle = 0
+        while True:
+            job = review_jobs.status(job_id)
+            if job is None:
+                yield 'event: error\ndata: {"message": "审核任务不存在或已过期"}\n\n'
+                return
+            for index, item in enumerate(job['items']):
+                if item['state'] != 'pending' and index not in sent:
+                    sent.add(index)
+                    idle = 0
+                    yield f"event: result\ndata: {json.dumps(item, ensure_ascii=False)}\n\n"
+            if job['status'] != 'running':
+                job.pop('items')
+                yield f"event: done\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+                return
+            idle += 1
+            if idle * app.config['REVIEW_EVENT_INTERVAL'] >= 15:
+                idle = 0
+                yield ': keepalive\n\n'
+            time.sleep(app.config['REVIEW_EVENT_INTERVAL'])
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
+@app.route('/admin/review_rules', methods=['GET', 'POST'])
+@admin_required
+def admin_review_rules():
+    """维护自动审核的本地黑白名单"""
+    if request.method == 'POST':
+        rules = {}
+        for name in REVIEW_RULE_LISTS:
+            lines = request.form.get(name, '').splitlines()
+            rules[name] = [line.strip() for line in lines if line.strip()]
+        
+        if state_store.set('review_rules', rules):
+            flash('审核名单更新成功!', 'success')
+        else:
+            flash('审核名单更新失败!', 'danger')
+        
+        return redirect(url_for('admin_review_rules'))
+    
+    rules = state_store.get('review_rules')
+    return render_template('admin_review_rules.html',
+                          rules={name: '\n'.join(rules.get(name, [])) for name in REVIEW_RULE_LISTS})
 
 @app.route('/admin/apply_review_results', methods=['POST'])
 @admin_required
 def apply_review_results():
     """
-    应用审核结果到歌曲列表
+    应用审核结果：删除选中结果中未通过审核的歌曲
+    请求体为 {"job_id": 审核任务ID, "request_ids": [点歌记录id, ...]}
     """
     try:
-        global recent_review_results
-        
         # 获取请求数据
-        data = request.get_json()
-        selected_indices = data.get('indices', [])
-        
-        if not selected_indices:
+        data = request.get_json(silent=True) or {}
+        job = review_jobs.status(data.get('job_id'))
+        if job is None:
             return jsonify({
                 'status': 'error',
-                'message': '未选择任何审核结果'
-            }), 400
-        
-        # 获取当前歌曲列表
-        today_requests = get_daily_list()
-        
-        # 解析 recent_review_results（可能是字符串或已解析的列表）
-        review_results = recent_review_results
-        if isinstance(review_results, str):
-            try:
-                # 如果是字符串，尝试解析为JSON
-                review_results = json.loads(review_results)
-            except json.JSONDecodeError as e:
-                app.logger.error(f"审核结果JSON解析错误: {e}")
-                return jsonify({
-                    'status': 'error',
-                    'message': '审核结果格式错误：无法解析JSON'
-                }), 500
+                'message': '审核任务不存在或已过期'
+            }), 404
         
-        # 确保 review_results 是一个列表
-        if not isinstance(review_results, list):
-            app.logger.error(f"审核结果不是列表类型: {type(review_results)}")
+        selected_ids = set(data.get('request_ids') or [])
+        if not selected_ids:
             return jsonify({
                 'status': 'error',
-                'message': '审核结果格式错误：不是有效的列表格式'
-            }), 500
+                'message': '未选择任何审核结果'
+            }), 400
         
-        # 创建一个集合来存储通过审核的歌曲名称
-        approved_songs = set()
+        # 点歌记录id在删除最大id后会被复用，只删除歌曲ID和歌名仍与审核时一致的记录
+        current = {song['id']: song for song in get_daily_list(job['date'])}
         applied_count = 0
-        
-        # 收集通过审核的歌曲名称
-        for index in selected_indices:
-            if 0 <= index < len(review_results):
-                review_result = review_results[index]
-                # 确保 review_result 是一个字典
-                if isinstance(review_result, dict):
-                    song_name = review_result.get('歌曲名称')
-                    passed = review_result.get('是否通过', True)
-                    
-                    # 如果歌曲通过审核，则添加到批准列表
-                    if passed and song_name:
-                        approved_songs.add(song_name)
-                    
-                    app.logger.info(f"应用审核结果: {song_name} - {'通过' if passed else '不通过'} - {review_result.get('原因', '无原因')}")
-                    applied_count += 1
-                else:
-                    app.logger.error(f"审核结果项不是字典类型: {type(review_result)}")
-        
-        # 过滤掉未通过审核的歌曲（保留在approved_songs中的歌曲）
-        filtered_list = [song for song in today_requests if song.get('song_name') in approved_songs]
-        deleted_count = len(today_requests) - len(filtered_list)
-        
-        # 保存更新后的列表
-        if save_daily_list(filtered_list):
+        rejected_ids = []
+        for item in job['items']:
+            if item['id'] not in selected_ids or item['state'] != 'done':
+                continue
+            applied_count += 1
+            app.logger.info(f"应用审核结果: {item['song_name']} - {'通过' if item['passed'] else '不通过'} - {item['reason']}")
+            if item['passed']:
+                continue
+            song = current.get(item['id'])
+            if (song is None or song.get('song_id') != item.get('song_id')
+                    or song.get('song_name') != item['song_name']):
+                app.logger.warning(f"点歌记录 {item['id']} 已变化，跳过删除: {item['song_name']}")
+                continue
+            rejected_ids.append(item['id'])
+        
+        # 删除未通过审核的歌曲
+        deleted_count = storage.delete(job['date'], rejected_ids)
+        
+        if deleted_count is not None:
             app.logger.info(f"已删除 {deleted_count} 首未通过审核的歌曲")
         else:
             app.logger.error("保存更新后的歌曲列表失败")
@@ -1548,10 +1837,30 @@ def apply_review_results():
         }), 500
 
 
+# 歌曲包在后台打包，进度通过 /admin/download_songs/status/<job_id> 查询
+app.config['ZIP_JOBS_DIR'] = os.path.join(app.config['DATA_DIR'], 'zip_jobs')
+# stream：下载完成后直接从下载目录边打包边输出（默认）；file：先在 ZIP_OUTPUT_DIR 生成完整ZIP
+app.config['ZIP_MODE'] = 'stream'
+app.config['ZIP_OUTPUT_DIR'] = tempfile.gettempdir()
+
+def fetch_song_for_zip(song):
+    """准备打包用的本地歌曲文件，本地没有时下载，返回 (文件路径, 消息)"""
+    if not song['song_id']:
+        return None, "缺少歌曲ID，跳过下载"
+    with upstream.priority('background'):
+        song_filepath, message, _ = download_single_song(song['song_id'], song['song_name'], song['artist'],
+                                                         level=app.config['BROADCAST_LEVEL'])
+    if not song_filepath:
+        app.logger.error(f"下载歌曲失败: {song['song_name']}, 错误: {message}")
+    return song_filepath, message
+
+zip_jobs = ZipJobManager(app.config['ZIP_JOBS_DIR'], fetch_song_for_zip,
+                         workers=app.config['MAX_CONCURRENT_DOWNLOADS'])
+
 @app.route('/admin/download_songs')
 @admin_required
 def download_songs():
-    """下载今日点歌列表中的歌曲并打包为ZIP"""
+    """创建打包任务：下载今日点歌列表中的歌曲并打包为ZIP"""
    
     # 获取今日点歌列表
     today_requests = get_daily_list()
@@ -1562,119 +1871,89 @@ def download_songs():
     # 按投票数从高到低排序
     today_requests_sorted = sorted(today_requests, key=lambda x: x.get('votes', 0), reverse=True)
         
-    app.logger.info(f"开始下载 {len(today_requests_sorted)} 首歌曲")
-        
-    # 创建临时目录存放下载的歌曲
-    temp_dir = tempfile.mkdtemp()
-    zip_filename = f"songs_{date.today().isoformat()}.zip"
-    zip_path = os.path.join(tempfile.gettempdir(), zip_filename)
-        
-    # 记录成功和失败的歌曲数量
-    success_count = 0
-    error_count = 0
-    
-    try:
-        # 创建ZIP文件
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            # 下载每首歌曲并添加到ZIP
-            for index, request in enumerate(today_requests_sorted, 1):
-                song_name = request['song_name']
-                artist = request.get('artist', '')
-                votes = request.get('votes', 0)
-                song_id = request.get('song_id')  # 获取歌曲ID
-                
-                # 如果没有歌曲ID，跳过下载
-                if not song_id:
-                    app.logger.warning(f"歌曲 '{song_name}' 缺少ID，跳过下载")
-                    error_count += 1
-                    continue
-                
-                try:
-                    # 清理文件名中的非法字符
-                    def sanitize_filename(name):
-                        """统一的文件名清理函数"""
-                        # 移除或替换非法字符
-                        illegal_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-                        for char in illegal_chars:
-                            name = name.replace(char, '_')
-                        
-                        # 移除控制字符
-                        name = ''.join(char for char in name if ord(char) >= 32)
-                        
-                        # 限制长度
-                        if len(name) > 100:
-                            name = name[:100]
-                        
-                        return name.strip()     
-                    
-                    # 构造可能已存在的文件名
-
-                    filename_title = song_name
-                    expected_filename = f"{sanitize_filename(filename_title)}.mp3"
-                    expected_filepath = os.path.join(app.config['SONG_DOWNLOAD_DIR'], expected_filename)
-                    
-                    # 检查文件是否已存在
-                    if os.path.exists(expected_filepath):
-                        # 使用已存在的文件
-                        song_filepath = expected_filepath
-                        app.logger.info(f"使用已存在的文件: {expected_filename}")
-                    else:
-                        # 文件不存在，需要下载
-                        song_filepath, message, lyric = download_single_song(song_id, song_name, artist)  # 修复这一行
-                        if not song_filepath:
-                            app.logger.error(f"下载歌曲失败: {song_name}, 错误: {message}")
-                            error_count += 1
-                            continue
-                    
-                    # 重新命名文件以包含序号和投票数
-                    new_filename = f"{index:02d}_{votes}票_{sanitize_filename(filename_title)}.mp3"
-                    new_filepath = os.path.join(temp_dir, new_filename)
-                    
-                    # 复制文件到临时目录并重命名
-                    shutil.copy2(song_filepath, new_filepath)
-                    
-                    # 添加到ZIP文件
-                    zipf.write(new_filepath, arcname=new_filename)
-                    success_count += 1
-                    
-                except Exception as e:
-                    app.logger.error(f"处理歌曲 '{song_name}' 时发生错误: {str(e)}")
-                    error_count += 1
-                    continue
-        
-        # 返回结果，包含成功和失败的统计信息
-        return jsonify({
-            'status': 'success',
-            'message': f'下载完成: 成功 {success_count} 首，失败 {error_count} 首',
-            'success_count': success_count,
-            'error_count': error_count,
-            'download_url': url_for('download_zip', filename=zip_filename)
+    app.logger.info(f"开始打包 {len(today_requests_sorted)} 首歌曲")
+    
+    songs = []
+    for index, item in enumerate(today_requests_sorted, 1):
+        song_name = item['song_name']
+        votes = item.get('votes', 0)
+        songs.append({
+            'song_id': item.get('song_id'),
+            'song_name': song_name,
+            'artist': item.get('artist', ''),
+            # 文件名包含序号和投票数
+            'arcname': f"{index:02d}_{votes}票_{sanitize_filename(song_name)}.mp3",
         })
     
+    list_date = get_today_date_str()
+    zip_path = None
+    if app.config['ZIP_MODE'] == 'file':
+        zip_path = os.path.join(app.config['ZIP_OUTPUT_DIR'], f"songs_{list_date}.zip")
+    
+    try:
+        job_id = zip_jobs.start(list_date, songs, zip_path)
     except Exception as e:
-        app.logger.error(f"下载歌曲时发生未知错误: {str(e)}")
+        app.logger.error(f"创建打包任务失败: {str(e)}")
         return jsonify({'status': 'error', 'message': f'系统错误: {str(e)}'}), 500
     
-    finally:
-        # 清理临时文件
-        def safe_delete(path):
-            try:
-                if os.path.isfile(path):
-                    os.remove(path)
-                elif os.path.isdir(path):
-                    shutil.rmtree(path)
-            except Exception as e:
-                app.logger.warning(f"删除临时文件失败: {path}, 错误: {str(e)}")
-        
-        safe_delete(temp_dir)
+    return jsonify({
+        'status': 'started',
+        'job_id': job_id,
+        'total': len(songs),
+        'status_url': url_for('download_songs_status', job_id=job_id)
+    })
+
+@app.route('/admin/download_songs/status/<job_id>')
+@admin_required
+def download_songs_status(job_id):
+    """查询打包任务进度"""
+    job = zip_jobs.status(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': '打包任务不存在或已过期'}), 404
+    if job['status'] == 'done':
+        if job['zip_name']:
+            job['download_url'] = url_for('download_zip', filename=job['zip_name'])
+        else:
+            job['download_url'] = url_for('download_songs_stream', job_id=job_id)
+    for item in job['items']:
+        item.pop('file', None)
+    return jsonify(job)
+
+@app.route('/admin/download_songs/stream/<job_id>')
+@admin_required
+def download_songs_stream(job_id):
+    """流式输出打包任务准备好的歌曲，按投票顺序命名"""
+    job = zip_jobs.status(job_id)
+    if job is None or job['status'] != 'done':
+        return "打包任务不存在或尚未完成", 404
+    
+    download_dir = os.path.abspath(app.config['SONG_DOWNLOAD_DIR'])
+    members = [(item['file'], item['arcname']) for item in job['items']
+               if item['state'] == 'done' and item.get('file')
+               and os.path.abspath(item['file']).startswith(download_dir + os.sep)]
+    zip_filename = f"songs_{job['created_at'][:10]}.zip"
+    return Response(
+        stream_with_context(stream_zip(members)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={zip_filename}'}
+    )
+
 @app.route('/download_zip/<filename>')
+@admin_required
 def download_zip(filename):
-    """提供ZIP文件下载"""
-    zip_path = os.path.join(tempfile.gettempdir(), filename)
+    """提供ZIP文件下载（需要登录，检查通过后才交给 nginx 发送）"""
+    # 只提供打包任务生成的文件
+    filename = os.path.basename(filename)
+    if not re.match(r'^songs_[\d-]+\.zip$', filename):
+        return "文件不存在或已过期", 404
+    zip_path = os.path.join(app.config['ZIP_OUTPUT_DIR'], filename)
     
     if not os.path.exists(zip_path):
         return "文件不存在或已过期", 404
     
+    if app.config['FILE_OFFLOAD'] == 'nginx':
+        return offload_file('zip', filename, 'application/zip', as_attachment=True)
+    
     return send_file(
         zip_path,
         as_attachment=True,
@@ -1742,6 +2021,8 @@ def clear_list():
 # 公告文件路径
 app.config['ANNOUNCEMENT_FILE'] = os.path.join(app.config['DATA_DIR'], 'announcement.json')
 
+state_store.register('announcement', app.config['ANNOUNCEMENT_FILE'], {"content": "", "enabled": False})
+
 def get_announcement():
     """获取公告内容"""
     announcement_file = app.config['ANNOUNCEMENT_FILE']
@@ -1749,13 +2030,7 @@ def get_announcement():
     if not os.path.abspath(announcement_file).startswith(os.path.abspath(app.config['DATA_DIR'])):
         return {"content": "", "enabled": False}
     
-    if os.path.exists(announcement_file):
-        try:
-            with open(announcement_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {"content": "", "enabled": False}
-    return {"content": "", "enabled": False}
+    return state_store.get('announcement')
 
 def save_announcement(content, enabled):
     """保存公告内容"""
@@ -1764,12 +2039,7 @@ def save_announcement(content, enabled):
     if not os.path.abspath(announcement_file).startswith(os.path.abspath(app.config['DATA_DIR'])):
         return False
     
-    try:
-        with open(announcement_file, 'w', encoding='utf-8') as f:
-            json.dump({"content": content, "enabled": enabled}, f, ensure_ascii=False, indent=2)
-        return True
-    except:
-        return False
+    return state_store.set('announcement', {"content": content, "enabled": enabled})
 
 # 公告管理路由
 @app.route('/admin/announcement', methods=['GET', 'POST'])
@@ -1801,12 +2071,37 @@ def api_announcement():
     announcement = get_announcement()
     return jsonify(announcement)
 
+# 缓存等运行指标
+def collect_metrics():
+    """汇总各缓存的命中统计"""
+    return {
+        'caches': {cache.name: cache.stats() for cache in (song_url_cache, song_lyric_cache, search_cache)},
+        'download_queue': download_queue.stats(),
+        'upstream': upstream.stats(),
+        'rate_limits': upstream_limiter.stats(),
+        'circuit_breakers': upstream.breaker_stats(),
+        'audio_cache': audio_cache.stats(),
+        'review_verdicts': review_verdicts.stats(),
+    }
+
+@app.route('/admin/metrics')
+@admin_required
+def admin_metrics():
+    return jsonify(collect_metrics())
+
 # 在模板中获取系统状态
 @app.template_global()
 def get_system_status_global():
     """在模板中获取系统状态"""
     return get_system_status()
 
+# 导入应用时即启动后台下载 worker（每个 gunicorn worker 进程各自启动，所有进程合计最多
+# MAX_CONCURRENT_DOWNLOADS 个下载），并接管上次退出时未完成的任务；设为 0 时只在点歌入队时启动
+# 使用 gunicorn --preload 时应关闭，否则线程只在 master 进程中启动
+app.config['DOWNLOAD_QUEUE_AUTOSTART'] = os.environ.get('DOWNLOAD_QUEUE_AUTOSTART', '1') == '1'
+if app.config['DOWNLOAD_QUEUE_AUTOSTART']:
+    download_queue.start()
+
 # 应用初始化
 if __name__ == '__main__':
     # 初始化管理员账户
@@ -1815,4 +2110,7 @@ if __name__ == '__main__':
     # 启动定时任务
     init_scheduler()
     
+    # 启动后台下载（继续上次未完成的任务）
+    download_queue.start()
+    
     app.run(debug=True)
\ No newline at end of file
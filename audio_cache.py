@@ -0,0 +1,186 @@
+# audio_cache.py - 本地歌曲文件缓存
+"""
+下载到本地的歌曲按 (song_id, 音质) 存放，文件名为 <song_id>_<level>.mp3，
+不同歌曲同名时不会互相覆盖，同一首歌在不同日期被点也不会重复下载。
+
+- 索引文件记录每个文件的大小、歌名、最近访问时间和命中次数
+- 总大小超过 max_bytes 时按 LRU（最久未访问）或 LFU（命中最少）淘汰
+- 多个进程共用同一个索引，修改时使用文件锁；访问记录先保存在内存中，
+  在下一次写索引或 flush() 时合并写回
+"""
+import os
+import re
+import time
+import threading
+
+from storage import file_signature, read_json, locked_update_json
+
+_LEVEL_RE = re.compile(r'^[a-z0-9]+$')
+_CACHE_FILE_RE = re.compile(r'^\d+_[a-z0-9]+\.mp3$')
+
+
+def cache_key(song_id, level='standard'):
+    return f"{song_id}_{level}"
+
+
+def is_cache_filename(filename):
+    """是否为缓存中的歌曲文件名（不包括 .part 等临时文件）"""
+    return bool(_CACHE_FILE_RE.match(filename))
+
+
+class AudioCache(object):
+    """按 song_id 和音质索引的本地歌曲文件缓存"""
+
+    def __init__(self, cache_dir, max_bytes, policy='lru', index_path=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.index_path = index_path or os.path.join(cache_dir, 'index.json')
+        self._lock = threading.Lock()
+        self._index = {}
+        self._signature = None
+        self._access = {}  # key -> [最近访问时间, 新增命中次数]，尚未写回索引
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _reload(self):
+        """索引文件被其他进程修改后重新读取（调用方持有 _lock）"""
+        signature = file_signature(self.index_path)
+        if signature != self._signature:
+            self._index = read_json(self.index_path)
+            self._signature = signature
+
+    def _update(self, func):
+        """在文件锁内读取-修改-写回索引，返回 func 的结果"""
+        def update(index):
+            for key, (accessed_at, hits) in self._access.items():
+                entry = index.get(key)
+                if entry:
+                    entry['last_access'] = max(entry['last_access'], accessed_at)
+                    entry['hits'] += hits
+            self._access = {}
+            self._index = index
+            return func(index), True
+
+        with self._lock:
+            result = locked_update_json(self.index_path, update)
+            self._signature = file_signature(self.index_path)
+            return result
+
+    def path_for(self, song_id, level='standard'):
+        """缓存文件应存放的路径"""
+        if not str(song_id).isdigit() or not _LEVEL_RE.match(level):
+            raise ValueError(f"无效的歌曲ID或音质: {song_id}, {level}")
+        return os.path.join(self.cache_dir, f"{cache_key(song_id, level)}.mp3")
+
+    def lookup(self, song_id, level='standard'):
+        """返回已缓存的文件路径并记录一次访问，未缓存时返回 None"""
+        if not song_id:
+            return None
+        key = cache_key(song_id, level)
+        with self._lock:
+            self._reload()
+            entry = self._index.get(key)
+            path = os.path.join(self.cache_dir, entry['file']) if entry else None
+            if path and os.path.exists(path):
+                self.hits += 1
+                access = self._access.setdefault(key, [0, 0])
+                access[0] = time.time()
+                access[1] += 1
+                return path
+            self.misses += 1
+            return None
+
+    def entry(self, filename):
+        """按文件名查找索引条目（用于下载时恢复歌名）"""
+        with self._lock:
+            self._reload()
+            for entry in self._index.values():
+                if entry['file'] == filename:
+                    return dict(entry)
+        return None
+
+    def put(self, song_id, level, src_path, song_name=''):
+        """把下载好的文件移入缓存并登记，超出容量时淘汰旧文件，返回缓存路径"""
+        path = self.path_for(song_id, level)
+        os.replace(src_path, path)
+        size = os.path.getsize(path)
+        now = time.time()
+
+        def add(index):
+            index[cache_key(song_id, level)] = {
+                'song_id': str(song_id),
+                'level': level,
+                'file': os.path.basename(path),
+                'song_name': song_name,
+                'size': size,
+                'created_at': now,
+                'last_access': now,
+                'hits': 0,
+            }
+            self._evict(index, keep=cache_key(song_id, level))
+        self._update(add)
+        return path
+
+    def _evict(self, index, keep=None):
+        """淘汰文件直到总大小不超过 max_bytes"""
+        total = sum(entry['size'] for entry in index.values())
+        if total <= self.max_bytes:
+            return
+        if self.policy == 'lfu':
+            order = sorted(index, key=lambda k: (index[k]['hits'], index[k]['last_access']))
+        else:
+            order = sorted(index, key=lambda k: index[k]['last_access'])
+        for key in order:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = index.pop(key)
+            total -= entry['size']
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.cache_dir, entry['file']))
+            except OSError:
+                pass
+
+    def flush(self):
+        """写回访问记录，清理索引与目录不一致的文件，并按容量淘汰"""
+        def maintain(index):
+            for key in [k for k, entry in index.items()
+                        if not os.path.exists(os.path.join(self.cache_dir, entry['file']))]:
+                del index[key]
+            known = {entry['file'] for entry in index.values()}
+            index_files = {os.path.basename(self.index_path), os.path.basename(self.index_path) + '.lock'}
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if name in known or name in index_files or not os.path.isfile(path):
+                    continue
+                # 正在下载的临时文件和下载锁文件保留一小时
+                if time.time() - os.path.getmtime(path) < 3600 and name.endswith(('.tmp', '.part', '.part.lock')):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._evict(index)
+        self._update(maintain)
+
+    def stats(self):
+        with self._lock:
+            self._reload()
+            total = sum(entry['size'] for entry in self._index.values())
+            entries = len(self._index)
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,185 @@
+# cache.py - 进程内缓存
+"""
+带过期时间的进程内LRU缓存。
+
+- ttl 内的条目直接命中
+- 过期但仍在 stale_ttl 窗口内的条目先返回旧值，同时在后台线程刷新（stale-while-revalidate）
+- 超过容量时淘汰最久未使用的条目
+- 空结果（例如“未找到”）可以使用更短的 negative_ttl 缓存
+- 同一个键同时只有一个加载请求，其余调用方等待并共享结果（single-flight）
+- 设置 fallback_errors 时，过期条目保留到被LRU淘汰为止；加载抛出这些异常（例如上游熔断）
+  时返回最后一次的旧值，而不是报错
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """线程安全的 LRU + TTL 缓存，并记录命中统计"""
+
+    def __init__(self, name, max_size=1024, ttl=600, stale_ttl=0, negative_ttl=None, fallback_errors=()):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.fallback_errors = tuple(fallback_errors)
+        self._data = OrderedDict()  # key -> (value, 写入时间, ttl)
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._inflight = {}  # key -> _Flight，正在加载的键
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.evictions = 0
+        self.fallbacks = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+
+    def _lookup(self, key):
+        """返回 (值, 状态)，状态为 'fresh' / 'stale' / 'expired' / None"""
+        entry = self._data.get(key)
+        if entry is None:
+            return None, None
+        value, stored_at, ttl = entry
+        age = time.monotonic() - stored_at
+        if age < ttl:
+            self._data.move_to_end(key)
+            return value, 'fresh'
+        if age < ttl + self.stale_ttl:
+            self._data.move_to_end(key)
+            return value, 'stale'
+        if self.fallback_errors:
+            return value, 'expired'
+        del self._data[key]
+        return None, None
+
+    def peek(self, key, allow_stale=False):
+        """只读取缓存，不触发加载，也不计入统计"""
+        with self._lock:
+            value, state = self._lookup(key)
+        if state == 'fresh' or (allow_stale and state == 'stale'):
+            return value
+        return None
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.negative_ttl if (not value and self.negative_ttl is not None) else self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic(), ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def get_or_load(self, key, loader, ttl=None, force=False):
+        """
+        读取缓存，未命中时调用 loader() 加载
+        loader 返回 None 表示没有结果，不写入缓存；loader 抛出的异常直接传给调用方，
+        属于 fallback_errors 且有过期旧值时返回旧值。
+        force=True 时即使命中也重新加载，加载成功才替换缓存，失败时返回旧值（没有旧值时抛出异常）。
+        同一个键正在加载时，其余调用方等待这次加载的结果而不是重复请求
+        """
+        with self._lock:
+            value, state = self._lookup(key)
+            if force and state is not None:
+                state = 'forced'
+            if state == 'fresh':
+                self.hits += 1
+                return value
+            if state == 'stale':
+                self.stale_hits += 1
+                start_refresh = key not in self._refreshing
+                if start_refresh:
+                    self._refreshing.add(key)
+            else:
+                flight = self._inflight.get(key)
+                is_leader = flight is None
+                if is_leader:
+                    self.misses += 1
+                    flight = self._inflight[key] = _Flight()
+                else:
+                    self.coalesced += 1
+
+        if state == 'stale':
+            if start_refresh:
+                threading.Thread(target=self._refresh, args=(key, loader, ttl), daemon=True).start()
+            return value
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self._load(key, loader, ttl)
+            return flight.value
+        except Exception as e:
+            if state == 'forced' or (state == 'expired' and isinstance(e, self.fallback_errors)):
+                self.fallbacks += 1
+                flight.value = value
+                return value
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def _load(self, key, loader, ttl):
+        started = time.monotonic()
+        value = loader()
+        self.loads += 1
+        self.load_seconds += time.monotonic() - started
+        if value is not None:
+            self.set(key, value, ttl)
+        return value
+
+    def _refresh(self, key, loader, ttl):
+        """后台刷新过期条目，失败时保留旧值直到彻底过期"""
+        try:
+            self._load(key, loader, ttl)
+            self.refreshes += 1
+        except Exception:
+            self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.coalesced + self.misses
+        avg_load = self.load_seconds / self.loads if self.loads else 0.0
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'hit_rate': round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'evictions': self.evictions,
+            'fallbacks': self.fallbacks,
+            'avg_load_ms': round(avg_load * 1000, 1),
+            # 命中和合并的请求按平均加载耗时估算节省的上游等待时间
+            'saved_upstream_ms': round((lookups - self.misses) * avg_load * 1000),
+        }
+
+
+class _Flight(object):
+    """一次正在进行的加载"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
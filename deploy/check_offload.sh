@@ -0,0 +1,46 @@
+#!/bin/sh
+# 检查 nginx 文件发送配置是否生效
+# 用法: sh deploy/check_offload.sh <nginx地址> <缓存中的歌曲文件名> [应用地址]
+# 例如: sh deploy/check_offload.sh http://127.0.0.1:8080 186016_standard.mp3 http://127.0.0.1:5000
+
+BASE=${1:-http://127.0.0.1:8080}
+FILE=$2
+APP=${3:-http://127.0.0.1:5000}
+
+if [ -z "$FILE" ]; then
+    echo "用法: $0 <nginx地址> <缓存中的歌曲文件名> [应用地址]"
+    exit 2
+fi
+
+fail=0
+check() {
+    if [ "$2" = "$3" ]; then
+        echo "通过: $1"
+    else
+        echo "失败: $1（期望 $3，实际 $2）"
+        fail=1
+    fi
+}
+
+# 1. 应用本身只返回 X-Accel-Redirect 头，不返回文件内容
+accel=$(curl -s -o /dev/null -D - "$APP/data/downloads/$FILE" | tr -d '\r' | grep -i '^X-Accel-Redirect:' | cut -d' ' -f2)
+check "应用返回 X-Accel-Redirect" "$accel" "/_protected/audio/$FILE"
+
+# 2. 经过 nginx 可以完整下载
+code=$(curl -s -o /dev/null -w '%{http_code}' "$BASE/data/downloads/$FILE")
+check "nginx 发送文件" "$code" "200"
+
+# 3. Range 请求返回 206
+code=$(curl -s -o /dev/null -w '%{http_code}' -H 'Range: bytes=0-1023' "$BASE/data/downloads/$FILE")
+check "Range 请求" "$code" "206"
+
+# 4. 带 ETag 的条件请求返回 304
+etag=$(curl -s -o /dev/null -D - "$BASE/data/downloads/$FILE" | tr -d '\r' | grep -i '^ETag:' | cut -d' ' -f2)
+code=$(curl -s -o /dev/null -w '%{http_code}' -H "If-None-Match: $etag" "$BASE/data/downloads/$FILE")
+check "If-None-Match 条件请求" "$code" "304"
+
+# 5. internal location 不能直接访问
+code=$(curl -s -o /dev/null -w '%{http_code}' "$BASE/_protected/audio/$FILE")
+check "internal location 不可直接访问" "$code" "404"
+
+exit $fail
@@ -0,0 +1,288 @@
+# download_queue.py - 歌曲后台下载队列
+"""
+提交点歌后的歌曲下载在后台线程池中进行，不再占用请求线程。
+
+- 同一首歌（song_id）只有一个下载任务
+- 失败后按指数退避重试，超过次数标记为 failed
+- 任务状态保存在 JSON 文件中，重启后未完成的任务会继续下载；
+  多个进程共用同一个状态文件，修改时使用文件锁，只有任务表变化时才写回
+- 所有进程合计同时运行的任务不超过 workers 个
+- 运行中任务记录所属进程的 (pid, 进程启动时间)，进程退出或 pid 被复用后
+  任务会被重新排队
+"""
+import os
+import time
+import uuid
+import random
+import threading
+from datetime import datetime, timedelta
+
+from storage import file_lock, read_json, locked_update_json
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+# 本进程的标识：容器重启后新进程可能拿到和旧进程相同的 pid（例如 1）
+_PROCESS_TOKEN = uuid.uuid4().hex
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def _process_start_time(pid):
+    """进程启动时间（Linux 下读取 /proc，单位为时钟滴答），无法获取时返回 None"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            # 进程名可能包含空格和括号，从最后一个 ')' 之后开始数字段
+            fields = f.read().rsplit(')', 1)[1].split()
+        return int(fields[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _current_owner():
+    pid = os.getpid()
+    return {'pid': pid, 'start': _process_start_time(pid), 'token': _PROCESS_TOKEN}
+
+
+def _owner_alive(owner):
+    """运行中任务的所属进程是否仍在运行"""
+    if not isinstance(owner, dict):
+        return False
+    if owner.get('pid') == os.getpid():
+        return owner.get('token') == _PROCESS_TOKEN
+    if not owner.get('pid') or not _pid_alive(owner['pid']):
+        return False
+    start = _process_start_time(owner['pid'])
+    return start is None or owner.get('start') is None or start == owner['start']
+
+
+class DownloadQueue(object):
+    """持久化的下载任务队列，worker 数量由 workers 限制"""
+
+    def __init__(self, state_path, download_func, workers=5, max_attempts=4,
+                 retry_backoff=10, keep_days=1, poll_interval=1.0):
+        # download_func(song_id, song_name, artist) -> (文件路径或None, 消息, 歌词)
+        self.state_path = state_path
+        self.download_func = download_func
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.keep_days = keep_days
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._threads = []
+        self._started = False
+
+    def _read(self):
+        return read_json(self.state_path)
+
+    def _locked_read(self, func):
+        """在共享文件锁内读取任务表并交给 func，不写回，返回 func 的结果"""
+        with file_lock(self.state_path, shared=True):
+            return func(self._read())
+
+    def _update(self, func):
+        """
+        在进程内锁和文件锁内读取-修改-写回任务表
+        func(jobs) 返回 (结果, 是否修改了任务表)，只有修改时才写回文件
+        """
+        def update(jobs):
+            result, changed = func(jobs)
+            return result, self._prune(jobs) or changed
+
+        with self._lock:
+            return locked_update_json(self.state_path, update)
+
+    def _prune(self, jobs):
+        """清理过期的已完成/失败任务，返回是否删除了任务"""
+        cutoff = (datetime.now() - timedelta(days=self.keep_days)).isoformat()
+        expired = [k for k, job in jobs.items()
+                   if job['state'] in (DONE, FAILED) and job['updated_at'] < cutoff]
+        for song_id in expired:
+            del jobs[song_id]
+        return bool(expired)
+
+    @staticmethod
+    def _stale(jobs):
+        """所属进程已经退出的运行中任务"""
+        return [job for job in jobs.values() if job['state'] == RUNNING and not _owner_alive(job.get('owner'))]
+
+    def _requeue_stale(self, jobs):
+        """把所属进程已经退出的运行中任务重新排队，返回是否有任务被重新排队"""
+        stale = self._stale(jobs)
+        for job in stale:
+            job['state'] = QUEUED
+            job['owner'] = None
+        return bool(stale)
+
+    def enqueue(self, song_id, song_name, artist=''):
+        """加入下载队列（已在队列中或已下载完成的歌曲不会重复下载），返回任务信息"""
+        song_id = str(song_id)
+        now = datetime.now().isoformat()
+
+        def add(jobs):
+            job = jobs.get(song_id)
+            if job and (job['state'] in (QUEUED, RUNNING) or
+                        (job['state'] == DONE and job.get('file') and os.path.exists(job['file']))):
+                return dict(job), False
+            jobs[song_id] = {
+                'song_id': song_id,
+                'song_name': song_name,
+                'artist': artist,
+                'state': QUEUED,
+                'attempts': 0,
+                'next_attempt_at': 0,
+                'owner': None,
+                'file': None,
+                'message': '',
+                'created_at': now,
+                'updated_at': now,
+            }
+            return dict(jobs[song_id]), True
+
+        job = self._update(add)
+        self.start()
+        self._notify()
+        return job
+
+    def _notify(self):
+        """唤醒本进程中等待任务的 worker（其他进程的 worker 按 poll_interval 检查）"""
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def status(self, song_id):
+        job = self._read().get(str(song_id))
+        return dict(job) if job else None
+
+    def stats(self):
+        """各状态的任务数量"""
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for job in self._read().values():
+            counts[job['state']] = counts.get(job['state'], 0) + 1
+        counts['workers'] = len(self._threads)
+        return counts
+
+    def start(self):
+        """启动 worker 线程，并接管上次退出时未完成的任务"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        self._update(lambda jobs: (None, self._requeue_stale(jobs)))
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'song-download-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _due(self, jobs):
+        now = time.time()
+        return [job for job in jobs.values() if job['state'] == QUEUED and job['next_attempt_at'] <= now]
+
+    def _claimable(self, jobs):
+        """是否有到期的排队任务且未达到并发上限，或者有需要重新排队的任务"""
+        if self._stale(jobs):
+            return True
+        running = sum(1 for job in jobs.values() if job['state'] == RUNNING)
+        return running < self.workers and bool(self._due(jobs))
+
+    def _claim(self):
+        """取出一个到期的排队任务并标记为运行中，所有进程合计最多 workers 个运行中任务"""
+        # 先在共享锁下检查，没有可取的任务时不获取排他锁、不写文件
+        if not self._locked_read(self._claimable):
+            return None
+        owner = _current_owner()
+
+        def claim(jobs):
+            changed = self._requeue_stale(jobs)
+            running = sum(1 for job in jobs.values() if job['state'] == RUNNING)
+            due = self._due(jobs)
+            if running >= self.workers or not due:
+                return None, changed
+            job = min(due, key=lambda j: j['created_at'])
+            job['state'] = RUNNING
+            job['owner'] = owner
+            job['attempts'] += 1
+            job['updated_at'] = datetime.now().isoformat()
+            return dict(job), True
+        return self._update(claim)
+
+    def _finish(self, song_id, file_path, message):
+        def finish(jobs):
+            job = jobs.get(song_id)
+            if job is None:
+                return None, False
+            job['owner'] = None
+            job['message'] = message
+            job['updated_at'] = datetime.now().isoformat()
+            if file_path:
+                job['state'] = DONE
+                job['file'] = file_path
+            elif job['attempts'] < self.max_attempts:
+                # 指数退避 + 抖动，避免同时失败的任务一起重试
+                delay = self.retry_backoff * (2 ** (job['attempts'] - 1))
+                job['state'] = QUEUED
+                job['next_attempt_at'] = time.time() + delay * random.uniform(0.8, 1.2)
+            else:
+                job['state'] = FAILED
+            return None, True
+        self._update(finish)
+        # 并发名额空出，唤醒等待中的 worker
+        self._notify()
+
+    def _settle(self, song_id, file_path, message):
+        """记录下载结果；_finish 出错时把任务标记为失败，不让它以运行中状态一直占用并发名额"""
+        try:
+            self._finish(song_id, file_path, message)
+            return
+        except Exception as e:
+            print(f"更新下载任务失败: {str(e)}")
+            message = f"更新下载任务失败: {str(e)}"
+
+        def fail(jobs):
+            job = jobs.get(song_id)
+            if job is None:
+                return None, False
+            job['state'] = FAILED
+            job['owner'] = None
+            job['message'] = message
+            job['updated_at'] = datetime.now().isoformat()
+            return None, True
+        self._update(fail)
+        self._notify()
+
+    def _worker(self):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                print(f"读取下载队列失败: {str(e)}")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            file_path, message = None, "下载中断"
+            try:
+                file_path, message, _ = self.download_func(job['song_id'], job['song_name'], job['artist'])
+            except Exception as e:
+                file_path, message = None, f"下载失败: {str(e)}"
+            finally:
+                try:
+                    self._settle(job['song_id'], file_path, message)
+                except Exception as e:
+                    print(f"标记下载任务失败时出错: {str(e)}")
@@ -0,0 +1,99 @@
+# ratelimit.py - 上游请求限流
+"""
+按 (主机, 优先级) 划分的令牌桶限流。
+
+令牌桶状态保存在一个 JSON 文件中，修改时使用文件锁，因此多个 worker 进程共享同一份额度。
+状态不需要在崩溃后保留，文件在锁内原地改写，不做 fsync；文件损坏时所有桶重新装满。
+不同优先级（例如交互式的搜索/播放，和后台的打包/预取）各自有独立的额度，
+后台任务用完额度不会影响学生搜索。
+
+额度用完时，调用方最多等待 max_wait 秒；仍拿不到令牌就立即抛出 RateLimited，
+而不是排队等到请求超时。
+"""
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+from storage import fcntl
+
+
+class RateLimited(Exception):
+    """上游请求额度已用完，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, bucket, retry_after):
+        super(RateLimited, self).__init__(f"{bucket} 请求过多，请 {retry_after:.1f} 秒后再试")
+        self.bucket = bucket
+        self.retry_after = retry_after
+
+
+class RateLimiter(object):
+    """
+    limits: {主机: {优先级: (每秒令牌数, 桶容量)}}，未配置的主机或优先级不限流
+    max_wait: {优先级: 最多等待秒数}
+    """
+
+    def __init__(self, state_path, limits, max_wait=None):
+        self.state_path = state_path
+        self.limits = limits
+        self.max_wait = max_wait or {}
+        self._lock = threading.Lock()
+        # 每次打开状态文件都是独立的文件描述，flock 同时在线程和进程之间互斥；
+        # 没有 fcntl 时才需要进程内锁
+        self._file_lock = threading.Lock() if fcntl is None else nullcontext()
+        self._stats = {}
+
+    def _count(self, bucket, field):
+        with self._lock:
+            stats = self._stats.setdefault(bucket, {'granted': 0, 'waited': 0, 'rejected': 0})
+            stats[field] += 1
+
+    def _take(self, bucket, rate, burst):
+        """尝试取一个令牌，成功返回 0，否则返回还需要等待的秒数"""
+        with self._file_lock:
+            with open(self.state_path, 'a+', encoding='utf-8') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    buckets = json.load(f)
+                except ValueError:
+                    buckets = {}
+                now = time.time()
+                tokens, updated = buckets.get(bucket, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                if tokens >= 1:
+                    buckets[bucket] = (tokens - 1, now)
+                    wait = 0
+                else:
+                    buckets[bucket] = (tokens, now)
+                    wait = (1 - tokens) / rate
+                f.seek(0)
+                f.truncate()
+                json.dump(buckets, f)
+                f.flush()
+                return wait
+
+    def acquire(self, host, priority):
+        """取得一次请求的额度，超过等待上限时抛出 RateLimited"""
+        limit = self.limits.get(host, {}).get(priority)
+        if not limit:
+            return
+        rate, burst = limit
+        bucket = f"{host}:{priority}"
+        deadline = time.monotonic() + self.max_wait.get(priority, 0)
+        waited = False
+        while True:
+            wait = self._take(bucket, rate, burst)
+            if wait == 0:
+                self._count(bucket, 'waited' if waited else 'granted')
+                return
+            if time.monotonic() + wait > deadline:
+                self._count(bucket, 'rejected')
+                raise RateLimited(bucket, wait)
+            waited = True
+            time.sleep(wait)
+
+    def stats(self):
+        with self._lock:
+            return {bucket: dict(stats) for bucket, stats in self._stats.items()}
@@ -0,0 +1,476 @@
+# review.py - 自动审核
+"""
+自动审核的结论存储和分批审核。
+
+每首歌的审核结论按 song_id 保存（没有 song_id 时按规范化后的歌名 + 歌手），
+同时记录结论、原因、使用的模型和提示词版本。模型或提示词版本变化后旧结论失效，
+下次审核时重新判断；其余歌曲直接使用已有结论，不再发送给 AI。
+
+发送给 AI 的只有审核规则需要的字段（编号、歌名、歌手、专辑，可选歌词片段），
+列表按固定大小分批并发审核，每条结果单独校验；某一批失败时只重新发送这一批中
+还没有结论的歌曲。模型流式输出时由 JsonArrayParser 增量解析，每完成一条结果立即交给调用方。
+
+发送给 AI 之前先做本地预审（PreScreen）：管理员维护的黑白名单和日文假名检测
+能直接判断的歌曲当场给出结论，只有剩下的歌曲才需要 AI 审核。
+
+审核作为后台任务执行，进度和结果按日期保存在 jobs_dir/<日期>/<任务ID>.json，
+任何一个进程都可以查询进度和应用结果。
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import random
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from storage import atomic_write_json, file_signature, read_json, locked_update_json
+
+
+def _normalize(text):
+    """全角转半角、忽略大小写、去掉空白和标点"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return re.sub(r'[\W_]+', '', text)
+
+
+def verdict_keys(song):
+    """歌曲在结论存储中的键：优先 song_id，其次歌名 + 歌手"""
+    keys = []
+    if song.get('song_id'):
+        keys.append(f"id:{song['song_id']}")
+    title = _normalize(song.get('song_name'))
+    if title:
+        keys.append(f"title:{title}|{_normalize(song.get('artists'))}")
+    return keys
+
+
+class VerdictStore(object):
+    """持久化的审核结论，多个进程共用同一个文件"""
+
+    def __init__(self, path, max_age_days=None):
+        self.path = path
+        self.max_age_days = max_age_days
+        self._lock = threading.Lock()
+        self._data = {}
+        self._signature = None
+        self.hits = 0
+        self.misses = 0
+
+    def _reload(self):
+        """文件被其他进程修改后重新读取（调用方持有 _lock）"""
+        signature = file_signature(self.path)
+        if signature != self._signature:
+            self._data = read_json(self.path)
+            self._signature = signature
+
+    def _valid(self, entry, model, prompt_version):
+        if entry.get('model') != model or entry.get('prompt_version') != prompt_version:
+            return False
+        if self.max_age_days:
+            cutoff = (datetime.now() - timedelta(days=self.max_age_days)).isoformat()
+            if entry.get('reviewed_at', '') < cutoff:
+                return False
+        return True
+
+    def lookup(self, song, model, prompt_version):
+        """返回仍然有效的结论，没有时返回 None"""
+        with self._lock:
+            self._reload()
+            for key in verdict_keys(song):
+                entry = self._data.get(key)
+                if entry and self._valid(entry, model, prompt_version):
+                    self.hits += 1
+                    return dict(entry)
+            self.misses += 1
+            return None
+
+    def record(self, verdicts, model, prompt_version):
+        """
+        保存一批结论，verdicts 为 [(歌曲, 是否通过, 原因), ...]
+        写入时一并删除模型或提示词版本不同、已过期的旧结论
+        """
+        if not verdicts:
+            return
+        now = datetime.now().isoformat(timespec='seconds')
+
+        def update(data):
+            for key, entry in list(data.items()):
+                if not self._valid(entry, model, prompt_version):
+                    del data[key]
+            for song, passed, reason in verdicts:
+                entry = {
+                    'song_id': str(song.get('song_id') or ''),
+                    'song_name': song.get('song_name', ''),
+                    'artists': song.get('artists', ''),
+                    'passed': bool(passed),
+                    'reason': reason,
+                    'model': model,
+                    'prompt_version': prompt_version,
+                    'reviewed_at': now,
+                }
+                for key in verdict_keys(song):
+                    data[key] = entry
+            self._data = data
+            return None, True
+
+        with self._lock:
+            locked_update_json(self.path, update)
+            self._signature = file_signature(self.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# 平假名、片假名（含半角片假名），不包括中文里也会用到的长音符号“ー”和间隔号“・”
+_KANA_RE = re.compile(r'[\u3041-\u3096\u30a1-\u30fa\u31f0-\u31ff\uff66-\uff9d]')
+
+
+def _compile_terms(terms):
+    """把名单编译为一个正则（字面量按长度从长到短选择），一次扫描匹配所有词；名单为空时返回 None"""
+    terms = sorted({_normalize(term) for term in terms if _normalize(term)}, key=len, reverse=True)
+    if not terms:
+        return None
+    return re.compile('|'.join(re.escape(term) for term in terms))
+
+
+class PreScreen(object):
+    """
+    本地预审，check(song) 返回 (是否通过, 原因)，无法判断时返回 None
+    名单按规范化后的歌名 / 歌手做包含匹配，判断顺序：
+    黑名单 > 白名单 > 歌名中有 title_kana 个以上假名或歌词中有 lyric_kana 个以上假名（日语歌曲）
+    """
+
+    def __init__(self, block_titles=(), block_artists=(), allow_titles=(), allow_artists=(),
+                 title_kana=2, lyric_kana=20):
+        self.block_titles = _compile_terms(block_titles)
+        self.block_artists = _compile_terms(block_artists)
+        self.allow_titles = _compile_terms(allow_titles)
+        self.allow_artists = _compile_terms(allow_artists)
+        self.title_kana = title_kana
+        self.lyric_kana = lyric_kana
+
+    @staticmethod
+    def _match(pattern, text):
+        if pattern is None or not text:
+            return None
+        match = pattern.search(text)
+        return match.group(0) if match else None
+
+    def check(self, song):
+        title = _normalize(song.get('song_name'))
+        artists = _normalize(song.get('artists'))
+        term = self._match(self.block_titles, title)
+        if term:
+            return False, f"歌名命中黑名单“{term}”"
+        term = self._match(self.block_artists, artists)
+        if term:
+            return False, f"歌手命中黑名单“{term}”"
+        term = self._match(self.allow_titles, title)
+        if term:
+            return True, f"歌名在白名单中“{term}”"
+        term = self._match(self.allow_artists, artists)
+        if term:
+            return True, f"歌手在白名单中“{term}”"
+        if len(_KANA_RE.findall(song.get('song_name') or '')) >= self.title_kana:
+            return False, "歌名包含日文假名，不允许日语歌曲"
+        if len(_KANA_RE.findall(song.get('lyric') or '')) >= self.lyric_kana:
+            return False, "歌词包含日文假名，不允许日语歌曲"
+        return None
+
+
+_LRC_TAG_RE = re.compile(r'\[[^\]]*\]')
+_LRC_META_RE = re.compile(r'^\s*(作词|作曲|编曲|制作人|词|曲)\s*[:：]')
+
+
+def lyric_excerpt(lyric, max_chars):
+    """去掉 LRC 时间标签和作词作曲信息，取歌词开头 max_chars 个字符"""
+    lines = []
+    for line in (lyric or '').splitlines():
+        line = _LRC_TAG_RE.sub('', line).strip()
+        if line and not _LRC_META_RE.match(line):
+            lines.append(line)
+    return ' / '.join(lines)[:max_chars]
+
+
+def review_payload(song, number, lyric_chars=0):
+    """发送给 AI 的单首歌曲信息，不包含封面、学生姓名等与审核无关的字段"""
+    item = {
+        '编号': number,
+        '歌曲名称': song.get('song_name', ''),
+        '歌手': song.get('artists', ''),
+        '专辑': song.get('album', ''),
+    }
+    if lyric_chars:
+        excerpt = lyric_excerpt(song.get('lyric'), lyric_chars)
+        if excerpt:
+            item['歌词片段'] = excerpt
+    return item
+
+
+def parse_review_json(text):
+    """解析 AI 返回的 JSON 数组（去除可能的代码块标记）"""
+    text = (text or '').strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else ''
+    if text.endswith('```'):
+        text = text[:-3]
+    return json.loads(text)
+
+
+class JsonArrayParser(object):
+    """
+    增量解析模型流式输出的 JSON 数组：feed() 传入新收到的文本，
+    返回其中新完成的顶层对象。数组之前的代码块标记和数组之后的文本被忽略
+    """
+
+    def __init__(self):
+        self._started = False
+        self._closed = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._buffer = []
+
+    def feed(self, text):
+        completed = []
+        for ch in text:
+            if self._closed:
+                break
+            if not self._started:
+                self._started = ch == '['
+                continue
+            if self._depth == 0:
+                # 数组元素之间只有逗号和空白
+                if ch == '{':
+                    self._depth = 1
+                    self._buffer = [ch]
+                elif ch == ']':
+                    self._closed = True
+                continue
+            self._buffer.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        completed.append(json.loads(''.join(self._buffer)))
+                    except ValueError:
+                        pass
+        return completed
+
+
+def _item_verdict(item, numbers):
+    """检查单条审核结果，返回 (编号, (是否通过, 原因))，无效时返回 None"""
+    if not isinstance(item, dict):
+        return None
+    number = item.get('编号')
+    if number not in numbers or not isinstance(item.get('是否通过'), bool):
+        return None
+    return number, (item['是否通过'], str(item.get('原因', '')))
+
+
+def review_in_batches(songs, review_batch, batch_size=20, workers=4, retries=2,
+                      backoff=1.0, lyric_chars=0, on_result=None, on_batch=None):
+    """
+    分批并发审核 songs
+    review_batch(payload, on_item) 返回 AI 输出的结果列表；流式输出时每解析出一条结果
+    就调用 on_item(结果)，不必等整批完成
+    返回与 songs 等长的列表，每项为 (是否通过, 原因)；重试后仍没有结论的歌曲对应 None
+    on_result(songs中的下标, (是否通过, 原因)) 在每首歌得到结论时调用（在审核线程中）
+    on_batch({songs中的下标: (是否通过, 原因)}) 在每批结束时（包括最终失败）以这一批得到的结论调用一次
+    批次中缺少结论的歌曲会重新发送，已得到结论的歌曲不再重复审核
+    """
+    payload = [review_payload(song, index + 1, lyric_chars) for index, song in enumerate(songs)]
+    batches = [payload[i:i + batch_size] for i in range(0, len(payload), batch_size)]
+    results = [None] * len(songs)
+
+    def run(batch):
+        try:
+            review(batch)
+        finally:
+            if on_batch is not None:
+                verdicts = {item['编号'] - 1: results[item['编号'] - 1] for item in batch
+                            if results[item['编号'] - 1] is not None}
+                if verdicts:
+                    on_batch(verdicts)
+
+    def review(batch):
+        remaining = {item['编号']: item for item in batch}
+        label = f"{batch[0]['编号']}-{batch[-1]['编号']}"
+
+        def on_item(item):
+            verdict = _item_verdict(item, remaining)
+            if verdict is None:
+                return
+            number, verdict = verdict
+            del remaining[number]
+            results[number - 1] = verdict
+            if on_result is not None:
+                on_result(number - 1, verdict)
+
+        for attempt in range(retries + 1):
+            try:
+                items = review_batch(list(remaining.values()), on_item)
+                if not isinstance(items, list):
+                    raise ValueError('审核结果不是列表')
+                for item in items:
+                    on_item(item)
+                if remaining:
+                    raise ValueError(f"审核结果缺少编号 {sorted(remaining)}")
+                return
+            except Exception as e:
+                print(f"审核批次 {label} 第 {attempt + 1} 次失败: {e}")
+                if attempt < retries:
+                    time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    if batches:
+        with ThreadPoolExecutor(max_workers=min(workers, len(batches))) as executor:
+            list(executor.map(run, batches))
+    return results
+
+
+_JOB_ID_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})_[0-9a-f]{32}$')
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ReviewJobManager(object):
+    """
+    review_func(songs, on_result)：审核 songs，每得到一首歌的结论调用
+    on_result(下标, 是否通过, 原因, 来源)，可以在多个线程中调用
+    """
+
+    def __init__(self, jobs_dir, review_func, keep_days=7):
+        self.jobs_dir = jobs_dir
+        self.review_func = review_func
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self._running = {}  # 日期 -> job_id，本进程中正在进行的任务
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _job_path(self, job_id):
+        match = _JOB_ID_RE.match(job_id or '')
+        if not match:
+            return None
+        return os.path.join(self.jobs_dir, match.group(1), f"{job_id}.json")
+
+    def status(self, job_id):
+        """读取任务进度和结果，任务不存在时返回 None"""
+        path = self._job_path(job_id)
+        if path is None:
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _cleanup(self):
+        """删除过期日期的任务记录"""
+        cutoff = (datetime.now() - timedelta(days=self.keep_days)).strftime('%Y-%m-%d')
+        for name in os.listdir(self.jobs_dir):
+            if re.match(r'^\d{4}-\d{2}-\d{2}$', name) and name < cutoff:
+                shutil.rmtree(os.path.join(self.jobs_dir, name), ignore_errors=True)
+
+    def start(self, date_str, songs):
+        """
+        创建审核任务并在后台执行，返回任务ID
+        同一天已有任务在进行时直接返回该任务
+        """
+        with self._lock:
+            job_id = self._running.get(date_str)
+            if job_id:
+                return job_id
+            job_id = f"{date_str}_{uuid.uuid4().hex}"
+            self._running[date_str] = job_id
+
+        self._cleanup()
+        os.makedirs(os.path.dirname(self._job_path(job_id)), exist_ok=True)
+        job = {
+            'job_id': job_id,
+            'date': date_str,
+            'status': 'running',
+            'message': '',
+            'total': len(songs),
+            'completed': 0,
+            'sources': {},
+            'created_at': datetime.now().isoformat(),
+            'finished_at': None,
+            'items': [{
+                'id': song['id'],
+                'song_id': song.get('song_id'),
+                'song_name': song.get('song_name', ''),
+                'artists': song.get('artists', ''),
+                'state': PENDING,
+                'passed': None,
+                'reason': '',
+                'source': None,
+            } for song in songs],
+        }
+        atomic_write_json(self._job_path(job_id), job)
+        threading.Thread(target=self._run, args=(job, songs),
+                         name=f'review-job-{job_id[-8:]}', daemon=True).start()
+        return job_id
+
+    def _run(self, job, songs):
+        job_lock = threading.Lock()
+
+        def save():
+            atomic_write_json(self._job_path(job['job_id']), job)
+
+        def on_result(index, passed, reason, source):
+            with job_lock:
+                item = job['items'][index]
+                if item['state'] != PENDING:
+                    return
+                item.update(state=DONE, passed=bool(passed), reason=reason, source=source)
+                job['completed'] += 1
+                job['sources'][source] = job['sources'].get(source, 0) + 1
+                save()
+
+        try:
+            self.review_func(songs, on_result)
+            with job_lock:
+                failed = 0
+                for item in job['items']:
+                    if item['state'] == PENDING:
+                        item['state'] = FAILED
+                        failed += 1
+                if failed and failed == job['total']:
+                    job['status'] = 'error'
+                    job['message'] = '审核失败，请稍后重试'
+                else:
+                    job['status'] = 'done'
+                    job['message'] = f"审核完成: {job['completed']} 首有结论，{failed} 首审核失败"
+        except Exception as e:
+            print(f"审核任务 {job['job_id']} 出错: {e}")
+            job['status'] = 'error'
+            job['message'] = f"审核失败: {str(e)}"
+        finally:
+            job['finished_at'] = datetime.now().isoformat()
+            with job_lock:
+                save()
+            with self._lock:
+                self._running.pop(job['date'], None)
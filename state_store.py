@@ -0,0 +1,68 @@
+# state_store.py - 小型配置/状态文件的内存存储
+"""
+系统状态、公告、管理员账户、更新日志等小型JSON文件的统一存储。
+
+文件只在启动后第一次使用时读取，之后从内存返回；每隔 poll_interval 秒
+检查一次文件版本（inode / mtime / size），被其他进程或手工修改后自动重新加载。
+写入使用临时文件 + 重命名，保证读取方不会读到写了一半的文件。
+"""
+import copy
+import time
+import threading
+
+from storage import atomic_write_json, file_signature, read_json
+
+
+class _Document(object):
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+        self.value = None
+        self.signature = None
+        self.loaded = False
+        self.checked_at = 0.0
+
+
+class StateStore(object):
+    """按名称注册的JSON文档，读取走内存，变更时重新加载"""
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self._docs = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, path, default):
+        """注册一个文档；文件不存在或无法解析时使用 default"""
+        self._docs[name] = _Document(path, default)
+
+    def _reload(self, doc):
+        signature = file_signature(doc.path)
+        if doc.loaded and signature == doc.signature:
+            return
+        doc.value = read_json(doc.path, doc.default)
+        doc.signature = signature
+        doc.loaded = True
+
+    def get(self, name):
+        """读取文档（返回副本，调用方可以修改）"""
+        doc = self._docs[name]
+        with self._lock:
+            now = time.monotonic()
+            if not doc.loaded or now - doc.checked_at >= self.poll_interval:
+                self._reload(doc)
+                doc.checked_at = now
+            return copy.deepcopy(doc.value)
+
+    def set(self, name, value):
+        """原子写入文档并更新内存中的值"""
+        doc = self._docs[name]
+        with self._lock:
+            try:
+                atomic_write_json(doc.path, value)
+            except (OSError, TypeError, ValueError):
+                return False
+            doc.value = copy.deepcopy(value)
+            doc.signature = file_signature(doc.path)
+            doc.loaded = True
+            doc.checked_at = time.monotonic()
+            return True
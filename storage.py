@@ -0,0 +1,990 @@
+# storage.py - 点歌列表存储后端
+"""
+每日点歌列表的存储后端。
+
+- json:   默认后端，每天一个 data/YYYY-MM-DD.json 文件（与旧版本格式完全一致）
+- journal: JSON快照 + 每天一个追加写的操作日志 data/YYYY-MM-DD.log，
+          投票等操作只追加一行，定期合并回快照
+- sqlite: SQLite（WAL 模式），投票、点歌、删除等操作均为单个事务
+
+app.py 只通过 create_storage() 返回的对象读写点歌列表，
+通过 STORAGE_BACKEND 配置切换后端。
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有文件锁，只有各模块自己的进程内锁
+    fcntl = None
+
+# add_request 的返回状态
+ADD_OK = 'ok'
+ADD_LIMIT = 'limit'
+ADD_DUPLICATE_SONG = 'duplicate_song'
+ADD_DUPLICATE_STUDENT = 'duplicate_student'
+ADD_ERROR = 'error'
+
+# 点歌记录中作为独立列保存的字段，其余字段存入 extra
+CORE_FIELDS = ('id', 'song_name', 'class_name', 'student_name', 'request_date', 'votes', 'song_id')
+
+
+def is_valid_date_str(date_str):
+    """检查日期字符串是否为YYYY-MM-DD格式"""
+    try:
+        datetime.strptime(date_str, '%Y-%m-%d')
+        return True
+    except (ValueError, TypeError):
+        return False
+
+
+def atomic_write_bytes(path, payload):
+    """原子写入文件：先写临时文件再重命名，避免写到一半的文件被读取"""
+    dir_name = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def dump_json_bytes(data):
+    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def atomic_write_json(path, data):
+    """原子写入JSON文件"""
+    atomic_write_bytes(path, dump_json_bytes(data))
+
+
+def stat_signature(st):
+    """文件版本标识：原子替换会换 inode，普通写入会改 mtime/size"""
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def file_signature(path):
+    """文件的版本标识，文件不存在时返回 None"""
+    try:
+        return stat_signature(os.stat(path))
+    except OSError:
+        return None
+
+
+def read_json(path, default=None):
+    """读取JSON文件，文件不存在或无法解析时返回 default（默认为空字典）"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {} if default is None else default
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """在 path + '.lock' 上加文件锁，多个进程之间互斥（没有 fcntl 时不加锁）"""
+    with open(path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+def locked_update_json(path, func, default=None):
+    """
+    在文件锁内读取-修改-写回JSON文件，返回 func 的结果
+    func(data) 返回 (结果, 是否修改了 data)，只有修改时才原子写回
+    多个线程同时调用时，调用方还需要自己的进程内锁（每次 open 都是独立的文件描述，
+    flock 本身也能在线程之间互斥，但没有 fcntl 时只能依靠进程内锁）
+    """
+    with file_lock(path):
+        data = read_json(path, default)
+        result, changed = func(data)
+        if changed:
+            atomic_write_json(path, data)
+        return result
+
+
+def is_duplicate_song(item, record):
+    """判断两条点歌记录是否为同一首歌（基于歌曲ID或歌曲名和歌手）"""
+    song_id = record.get('song_id')
+    if song_id and item.get('song_id') == song_id:
+        return True
+    return (item['song_name'].lower() == record['song_name'].lower()
+            and item.get('artist', '').lower() == record.get('artist', '').lower())
+
+
+def check_new_request(today_list, record, max_requests):
+    """检查新的点歌记录能否加入列表，返回 add_request 的状态"""
+    if max_requests is not None and len(today_list) >= max_requests:
+        return ADD_LIMIT
+    for item in today_list:
+        if is_duplicate_song(item, record):
+            return ADD_DUPLICATE_SONG
+    for item in today_list:
+        if item['student_name'] == record['student_name']:
+            return ADD_DUPLICATE_STUDENT
+    return ADD_OK
+
+
+
+class JsonStorage(object):
+    """JSON文件后端：每天一个文件，读-改-写由进程内锁保护"""
+
+    name = 'json'
+    # 进程内最多缓存的日期数（当天列表 + 少量历史查询）
+    cache_size = 8
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._lock = threading.RLock()
+        # date_str -> (文件版本标识, 歌曲列表)，所有读取共享
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _path(self, date_str):
+        filename = os.path.join(self.data_dir, f"{date_str}.json")
+        # 确保文件路径在数据目录内
+        if not os.path.abspath(filename).startswith(os.path.abspath(self.data_dir)):
+            return None
+        return filename
+
+    def exists(self, date_str):
+        path = self._path(date_str)
+        return bool(path) and os.path.exists(path)
+
+    def _cache_put(self, date_str, signature, data):
+        with self._cache_lock:
+            self._cache.pop(date_str, None)
+            self._cache[date_str] = (signature, data)
+            while len(self._cache) > self.cache_size:
+                self._cache.pop(next(iter(self._cache)))
+
+    def _load_shared(self, date_str):
+        """
+        读取歌曲列表的共享副本（调用方不能修改）
+        文件版本标识未变时直接返回缓存，不再解析JSON
+        """
+        path = self._path(date_str)
+        if not path:
+            return []
+        signature = file_signature(path)
+        if signature is None:
+            with self._cache_lock:
+                self._cache.pop(date_str, None)
+            return []
+
+        cached = self._cache.get(date_str)
+        if cached and cached[0] == signature:
+            self.cache_hits += 1
+            return cached[1]
+
+        self.cache_misses += 1
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                # 用同一个文件描述符的版本标识，避免读取期间文件被替换造成错配
+                signature = stat_signature(os.fstat(f.fileno()))
+                data = json.load(f)
+        except (OSError, ValueError):
+            return []
+        self._cache_put(date_str, signature, data)
+        return data
+
+    def load(self, date_str):
+        """读取指定日期的歌曲列表（返回可修改的副本）"""
+        return [dict(item) for item in self._load_shared(date_str)]
+
+    def save(self, date_str, data):
+        """整体覆盖保存指定日期的歌曲列表，并更新缓存"""
+        path = self._path(date_str)
+        if not path:
+            return False
+        with self._lock:
+            try:
+                atomic_write_json(path, data)
+                signature = stat_signature(os.stat(path))
+            except (OSError, TypeError, ValueError):
+                return False
+            # 写入后的新版本直接进入缓存，本进程无需重新读取；
+            # 其他进程通过文件版本标识的变化发现更新
+            self._cache_put(date_str, signature, [dict(item) for item in data])
+            return True
+
+    def count(self, date_str):
+        return len(self._load_shared(date_str))
+
+    def add_request(self, date_str, record, max_requests=None):
+        """添加点歌记录，返回 (状态, 新记录)"""
+        with self._lock:
+            today_list = self.load(date_str)
+            status = check_new_request(today_list, record, max_requests)
+            if status != ADD_OK:
+                return status, None
+
+            new_record = dict(record)
+            new_record['id'] = max([item['id'] for item in today_list], default=0) + 1
+            new_record.setdefault('votes', 0)
+            today_list.append(new_record)
+            if not self.save(date_str, today_list):
+                return ADD_ERROR, None
+            return ADD_OK, new_record
+
+    def vote(self, date_str, request_id):
+        """为歌曲投票，返回新的票数；歌曲不存在或保存失败时返回 None"""
+        with self._lock:
+            today_list = self.load(date_str)
+            for song in today_list:
+                if song['id'] == request_id:
+                    song['votes'] = song.get('votes', 0) + 1
+                    if self.save(date_str, today_list):
+                        return song['votes']
+                    return None
+            return None
+
+    def set_lyric(self, date_str, request_id, lyric):
+        """更新歌曲的歌词，返回是否成功"""
+        with self._lock:
+            today_list = self.load(date_str)
+            for song in today_list:
+                if song['id'] == request_id:
+                    song['lyric'] = lyric
+                    return self.save(date_str, today_list)
+            return False
+
+    def delete(self, date_str, request_ids):
+        """删除指定ID的歌曲，返回删除数量；保存失败时返回 None"""
+        request_ids = set(request_ids)
+        with self._lock:
+            today_list = self.load(date_str)
+            filtered_list = [item for item in today_list if item['id'] not in request_ids]
+            if not self.save(date_str, filtered_list):
+                return None
+            return len(today_list) - len(filtered_list)
+
+    def remove_list(self, date_str):
+        """删除整天的数据"""
+        path = self._path(date_str)
+        with self._cache_lock:
+            self._cache.pop(date_str, None)
+        if path and os.path.exists(path):
+            os.remove(path)
+            return True
+        return False
+
+    def list_dates(self):
+        """获取所有有数据的日期（倒序）"""
+        dates = []
+        for f in os.listdir(self.data_dir):
+            if f.endswith('.json'):
+                date_str = f[:-len('.json')]
+                if is_valid_date_str(date_str):
+                    dates.append(date_str)
+        return sorted(dates, reverse=True)
+
+    def compact(self):
+        """JSON后端每次都整体写入，无需合并"""
+        return 0
+
+
+def apply_journal_entry(data, entry):
+    """把一条操作日志应用到歌曲列表上（原地修改）"""
+    op = entry.get('op')
+    if op == 'add':
+        data.append(entry['record'])
+    elif op == 'vote':
+        for song in data:
+            if song['id'] == entry['id']:
+                song['votes'] = song.get('votes', 0) + 1
+                break
+    elif op == 'lyric':
+        for song in data:
+            if song['id'] == entry['id']:
+                song['lyric'] = entry['lyric']
+                break
+    elif op == 'delete':
+        ids = set(entry['ids'])
+        data[:] = [song for song in data if song['id'] not in ids]
+
+
+class _JournalState(object):
+    """某一天的内存状态：快照版本 + 已应用到的日志位置"""
+
+    def __init__(self, snapshot_signature, header, offset, valid, data):
+        self.snapshot_signature = snapshot_signature
+        self.header = header
+        self.offset = offset
+        self.valid = valid
+        self.data = data
+
+
+class JournalStorage(JsonStorage):
+    """
+    快照 + 操作日志后端
+    data/YYYY-MM-DD.json 仍是完整可读的快照；每次点歌、投票、删除、审核
+    只向 data/YYYY-MM-DD.log 追加一行JSON。日志第一行记录它所基于的快照的
+    哈希，合并时先原子替换快照、再清空日志，中途崩溃也不会重复应用日志。
+    """
+
+    name = 'journal'
+
+    def __init__(self, data_dir, fsync_window=0.005):
+        super(JournalStorage, self).__init__(data_dir)
+        # 组提交窗口（秒）：窗口内的多次追加共用一次 fsync
+        self.fsync_window = fsync_window
+        self._states = {}
+        self._fds = {}
+        self._sync_cond = threading.Condition()
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._syncing = False
+        self._dirty_fds = set()
+
+    def _journal_path(self, date_str):
+        path = self._path(date_str)
+        return path[:-len('.json')] + '.log' if path else None
+
+    def _journal_fd(self, date_str, create):
+        """
+        返回日志文件的 fd（调用方持有 _lock）
+        只长期保留今天的 fd；缓存的 fd 对应的文件已被其他进程删除或替换时重新打开
+        """
+        today = datetime.now().strftime('%Y-%m-%d')
+        with self._sync_cond:
+            dirty = set(self._dirty_fds)
+        for day, cached in list(self._fds.items()):
+            # 还没有 fsync 的 fd 留到下一次再关闭
+            if day not in (today, date_str) and cached not in dirty:
+                self._close_journal(day)
+
+        path = self._journal_path(date_str)
+        fd = self._fds.get(date_str)
+        if fd is not None:
+            try:
+                replaced = os.stat(path).st_ino != os.fstat(fd).st_ino
+            except OSError:
+                replaced = True
+            if replaced:
+                self._close_journal(date_str)
+                fd = None
+        if fd is None:
+            flags = os.O_RDWR | os.O_APPEND
+            if create:
+                flags |= os.O_CREAT
+            try:
+                fd = os.open(path, flags, 0o644)
+            except FileNotFoundError:
+                return None
+            self._fds[date_str] = fd
+        return fd
+
+    def _close_journal(self, date_str):
+        fd = self._fds.pop(date_str, None)
+        if fd is not None:
+            with self._sync_cond:
+                self._dirty_fds.discard(fd)
+            os.close(fd)
+
+    @staticmethod
+    def _flock(fd, mode):
+        """跨进程文件锁，mode 为 'sh' / 'ex' / 'un'"""
+        if fcntl is not None and fd is not None:
+            fcntl.flock(fd, {'sh': fcntl.LOCK_SH, 'ex': fcntl.LOCK_EX, 'un': fcntl.LOCK_UN}[mode])
+
+    def _read_snapshot(self, date_str):
+        """返回 (快照版本标识, 快照哈希, 歌曲列表)"""
+        try:
+            with open(self._path(date_str), 'rb') as f:
+                signature = stat_signature(os.fstat(f.fileno()))
+                payload = f.read()
+        except OSError:
+            return None, '', []
+        try:
+            data = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            data = []
+        return signature, hashlib.sha1(payload).hexdigest(), data
+
+    @staticmethod
+    def _read_from(fd, offset):
+        """读取 offset 之后的完整行，未写完的最后一行留到下次"""
+        size = os.fstat(fd).st_size
+        if size <= offset:
+            return b'', offset
+        chunk = os.pread(fd, size - offset, offset)
+        end = chunk.rfind(b'\n') + 1
+        return chunk[:end], offset + end
+
+    @staticmethod
+    def _parse_lines(chunk):
+        for line in chunk.splitlines():
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue  # 损坏的行（例如写入时崩溃）直接跳过
+
+    def _rebuild(self, date_str, fd):
+        """从快照 + 完整日志重建状态"""
+        signature, snapshot_hash, data = self._read_snapshot(date_str)
+        header, offset, valid = None, 0, False
+        if fd is not None:
+            chunk, offset = self._read_from(fd, 0)
+            entries = self._parse_lines(chunk)
+            first = next(entries, None)
+            if first is not None and first.get('op') == 'base':
+                header = first
+                # 日志基于的快照已被替换（合并完成但日志未清空），日志作废
+                valid = first.get('snapshot') == snapshot_hash
+                if valid:
+                    for entry in entries:
+                        apply_journal_entry(data, entry)
+        return _JournalState(signature, header, offset, valid, data)
+
+    def _refresh(self, date_str, fd):
+        """在持有日志锁时调用：增量读取其他进程追加的日志"""
+        signature = file_signature(self._path(date_str))
+
+        state = self._states.get(date_str)
+        if state is not None and state.snapshot_signature == signature:
+            if fd is None:
+                if state.offset == 0:
+                    self.cache_hits += 1
+                    return state
+            elif state.header is None:
+                if os.fstat(fd).st_size == state.offset:
+                    self.cache_hits += 1
+                    return state
+            else:
+                # 首行不变说明日志没有被清空重写，只需读取新增的部分
+                head = _encode_entry(state.header)
+                if os.fstat(fd).st_size >= state.offset and os.pread(fd, len(head), 0) == head:
+                    chunk, state.offset = self._read_from(fd, state.offset)
+                    if chunk and state.valid:
+                        for entry in self._parse_lines(chunk):
+                            apply_journal_entry(state.data, entry)
+                    self.cache_hits += 1
+                    return state
+
+        self.cache_misses += 1
+        state = self._rebuild(date_str, fd)
+        self._states[date_str] = state
+        return state
+
+    def _load_shared(self, date_str):
+        with self._lock:
+            fd = self._journal_fd(date_str, create=False)
+            self._flock(fd, 'sh')
+            try:
+                return self._refresh(date_str, fd).data
+            finally:
+                self._flock(fd, 'un')
+
+    def load(self, date_str):
+        with self._lock:
+            return [dict(item) for item in self._load_shared(date_str)]
+
+    def count(self, date_str):
+        with self._lock:
+            return len(self._load_shared(date_str))
+
+    def exists(self, date_str):
+        path = self._journal_path(date_str)
+        return super(JournalStorage, self).exists(date_str) or bool(path and os.path.exists(path))
+
+    def _reset_journal(self, fd, snapshot_hash):
+        """清空日志并写入新的首行（基于的快照哈希 + 随机代号）"""
+        header = {'op': 'base', 'snapshot': snapshot_hash, 'gen': uuid.uuid4().hex}
+        line = _encode_entry(header)
+        os.ftruncate(fd, 0)
+        os.write(fd, line)
+        os.fsync(fd)
+        return header, len(line)
+
+    def _write_snapshot(self, date_str, fd, data):
+        """原子替换快照，然后清空日志（持有日志写锁时调用）"""
+        payload = dump_json_bytes(data)
+        path = self._path(date_str)
+        atomic_write_bytes(path, payload)
+        header, offset = self._reset_journal(fd, hashlib.sha1(payload).hexdigest())
+        self._states[date_str] = _JournalState(
+            stat_signature(os.stat(path)), header, offset, True, [dict(item) for item in data]
+        )
+
+    def _mutate(self, date_str, build_entry):
+        """
+        在日志写锁内读取最新状态、生成日志项并追加，锁外等待组提交落盘
+        build_entry(data) 返回 (日志项或None, 返回值)
+        """
+        with self._lock:
+            fd = self._journal_fd(date_str, create=True)
+            self._flock(fd, 'ex')
+            try:
+                state = self._refresh(date_str, fd)
+                if not state.valid:
+                    # 新日志或已作废的日志：以当前快照为基础重新开始
+                    _, snapshot_hash, state.data = self._read_snapshot(date_str)
+                    state.header, state.offset = self._reset_journal(fd, snapshot_hash)
+                    state.valid = True
+                elif os.fstat(fd).st_size != state.offset:
+                    # 日志末尾有写了一半的行，截掉
+                    os.ftruncate(fd, state.offset)
+
+                entry, result = build_entry(state.data)
+                if entry is None:
+                    return result
+                line = _encode_entry(entry)
+                os.write(fd, line)
+                state.offset += len(line)
+                apply_journal_entry(state.data, json.loads(line.decode('utf-8')))
+                with self._sync_cond:
+                    self._written_seq += 1
+                    seq = self._written_seq
+                    self._dirty_fds.add(fd)
+            finally:
+                self._flock(fd, 'un')
+        self._wait_durable(seq)
+        return result
+
+    def _wait_durable(self, seq):
+        """组提交：第一个等待者在窗口结束后统一 fsync，其余等待者直接返回"""
+        with self._sync_cond:
+            while self._synced_seq < seq:
+                if self._syncing:
+                    self._sync_cond.wait()
+                    continue
+                self._syncing = True
+                break
+            else:
+                return
+
+        target = seq
+        try:
+            if self.fsync_window:
+                time.sleep(self.fsync_window)
+            with self._sync_cond:
+                target = self._written_seq
+                fds, self._dirty_fds = self._dirty_fds, set()
+            for fd in fds:
+                try:
+                    os.fsync(fd)
+                except OSError:
+                    pass
+        finally:
+            with self._sync_cond:
+                self._synced_seq = max(self._synced_seq, target)
+                self._syncing = False
+                self._sync_cond.notify_all()
+
+    def save(self, date_str, data):
+        """整体覆盖：写新快照并清空日志"""
+        if not self._path(date_str):
+            return False
+        with self._lock:
+            fd = self._journal_fd(date_str, create=True)
+            self._flock(fd, 'ex')
+            try:
+                self._write_snapshot(date_str, fd, data)
+                return True
+            except (OSError, TypeError, ValueError):
+                self._states.pop(date_str, None)
+                return False
+            finally:
+                self._flock(fd, 'un')
+
+    def add_request(self, date_str, record, max_requests=None):
+        def build_entry(today_list):
+            status = check_new_request(today_list, record, max_requests)
+            if status != ADD_OK:
+                return None, (status, None)
+            new_record = dict(record)
+            new_record['id'] = max([item['id'] for item in today_list], default=0) + 1
+            new_record.setdefault('votes', 0)
+            return {'op': 'add', 'record': new_record}, (ADD_OK, new_record)
+        try:
+            return self._mutate(date_str, build_entry)
+        except OSError:
+            return ADD_ERROR, None
+
+    def vote(self, date_str, request_id):
+        def build_entry(today_list):
+            for song in today_list:
+                if song['id'] == request_id:
+                    return {'op': 'vote', 'id': request_id}, song.get('votes', 0) + 1
+            return None, None
+        try:
+            return self._mutate(date_str, build_entry)
+        except OSError:
+            return None
+
+    def set_lyric(self, date_str, request_id, lyric):
+        def build_entry(today_list):
+            for song in today_list:
+                if song['id'] == request_id:
+                    return {'op': 'lyric', 'id': request_id, 'lyric': lyric}, True
+            return None, False
+        try:
+            return self._mutate(date_str, build_entry)
+        except OSError:
+            return False
+
+    def delete(self, date_str, request_ids):
+        request_ids = set(request_ids)
+
+        def build_entry(today_list):
+            ids = [song['id'] for song in today_list if song['id'] in request_ids]
+            if not ids:
+                return None, 0
+            return {'op': 'delete', 'ids': ids}, len(ids)
+        try:
+            return self._mutate(date_str, build_entry)
+        except OSError:
+            return None
+
+    def remove_list(self, date_str):
+        with self._lock:
+            self._close_journal(date_str)
+            self._states.pop(date_str, None)
+            path = self._journal_path(date_str)
+            if path and os.path.exists(path):
+                os.remove(path)
+            return super(JournalStorage, self).remove_list(date_str)
+
+    def list_dates(self):
+        dates = set(super(JournalStorage, self).list_dates())
+        for f in os.listdir(self.data_dir):
+            if f.endswith('.log') and is_valid_date_str(f[:-len('.log')]):
+                dates.add(f[:-len('.log')])
+        return sorted(dates, reverse=True)
+
+    def compact(self, date_str=None):
+        """把日志合并回快照，返回合并的天数"""
+        dates = [date_str] if date_str else self.list_dates()
+        compacted = 0
+        for day in dates:
+            path = self._journal_path(day)
+            if not path or not os.path.exists(path) or os.path.getsize(path) == 0:
+                continue
+            with self._lock:
+                fd = self._journal_fd(day, create=False)
+                if fd is None:
+                    continue
+                self._flock(fd, 'ex')
+                try:
+                    state = self._refresh(day, fd)
+                    if state.valid and state.header is not None and state.offset == len(_encode_entry(state.header)):
+                        continue  # 日志里只有首行，无需合并
+                    self._write_snapshot(day, fd, state.data)
+                    compacted += 1
+                finally:
+                    self._flock(fd, 'un')
+        return compacted
+
+
+def _encode_entry(entry):
+    return (json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_lists (
+    list_date TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS song_requests (
+    list_date TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    song_name TEXT NOT NULL,
+    song_key TEXT NOT NULL,
+    class_name TEXT NOT NULL DEFAULT '',
+    student_name TEXT NOT NULL,
+    request_date TEXT NOT NULL DEFAULT '',
+    votes INTEGER NOT NULL DEFAULT 0,
+    song_id TEXT NOT NULL DEFAULT '',
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (list_date, id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_song_requests_song_id
+    ON song_requests (list_date, song_id) WHERE song_id <> '';
+CREATE UNIQUE INDEX IF NOT EXISTS ux_song_requests_song_key
+    ON song_requests (list_date, song_key);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_song_requests_student
+    ON song_requests (list_date, student_name);
+"""
+
+
+def _song_key(record):
+    """歌曲名+歌手的唯一键（不区分大小写），与 is_duplicate_song 的判断一致"""
+    return f"{record['song_name'].lower()}\x1f{record.get('artist', '').lower()}"
+
+
+class SqliteStorage(object):
+    """SQLite（WAL）后端：每个操作都是一个事务，多进程并发投票不会丢失"""
+
+    name = 'sqlite'
+
+    def __init__(self, db_path, busy_timeout=5.0):
+        self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SQLITE_SCHEMA)
+
+    def _conn(self):
+        """每个线程使用自己的连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    @staticmethod
+    def _row_to_record(row):
+        record = {
+            'id': row['id'],
+            'song_name': row['song_name'],
+            'class_name': row['class_name'],
+            'student_name': row['student_name'],
+            'request_date': row['request_date'],
+            'votes': row['votes'],
+            'song_id': row['song_id'],
+        }
+        record.update(json.loads(row['extra'] or '{}'))
+        return record
+
+    @staticmethod
+    def _insert(conn, date_str, record):
+        extra = {k: v for k, v in record.items() if k not in CORE_FIELDS}
+        conn.execute(
+            'INSERT INTO song_requests (list_date, id, song_name, song_key, class_name, student_name, '
+            'request_date, votes, song_id, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (date_str, record['id'], record['song_name'], _song_key(record),
+             record.get('class_name', ''), record['student_name'], record.get('request_date', ''),
+             record.get('votes', 0), str(record.get('song_id') or ''),
+             json.dumps(extra, ensure_ascii=False))
+        )
+
+    def exists(self, date_str):
+        row = self._conn().execute('SELECT 1 FROM daily_lists WHERE list_date = ?', (date_str,)).fetchone()
+        return row is not None
+
+    def load(self, date_str):
+        rows = self._conn().execute(
+            'SELECT * FROM song_requests WHERE list_date = ? ORDER BY id', (date_str,)
+        ).fetchall()
+        return [self._row_to_record(row) for row in rows]
+
+    def save(self, date_str, data):
+        """整体替换指定日期的歌曲列表（单个事务）"""
+        try:
+            with self._transaction() as conn:
+                conn.execute('INSERT OR IGNORE INTO daily_lists (list_date) VALUES (?)', (date_str,))
+                conn.execute('DELETE FROM song_requests WHERE list_date = ?', (date_str,))
+                for record in data:
+                    self._insert(conn, date_str, record)
+            return True
+        except (sqlite3.Error, KeyError, TypeError, ValueError):
+            return False
+
+    def count(self, date_str):
+        row = self._conn().execute(
+            'SELECT COUNT(*) FROM song_requests WHERE list_date = ?', (date_str,)
+        ).fetchone()
+        return row[0]
+
+    def add_request(self, date_str, record, max_requests=None):
+        """插入点歌记录，由唯一索引保证歌曲和姓名不重复"""
+        try:
+            with self._transaction() as conn:
+                if max_requests is not None and self.count(date_str) >= max_requests:
+                    return ADD_LIMIT, None
+                song_id = str(record.get('song_id') or '')
+                if song_id and conn.execute(
+                        'SELECT 1 FROM song_requests WHERE list_date = ? AND song_id = ?',
+                        (date_str, song_id)).fetchone():
+                    return ADD_DUPLICATE_SONG, None
+                if conn.execute(
+                        'SELECT 1 FROM song_requests WHERE list_date = ? AND song_key = ?',
+                        (date_str, _song_key(record))).fetchone():
+                    return ADD_DUPLICATE_SONG, None
+                if conn.execute(
+                        'SELECT 1 FROM song_requests WHERE list_date = ? AND student_name = ?',
+                        (date_str, record['student_name'])).fetchone():
+                    return ADD_DUPLICATE_STUDENT, None
+
+                new_id = conn.execute(
+                    'SELECT COALESCE(MAX(id), 0) + 1 FROM song_requests WHERE list_date = ?', (date_str,)
+                ).fetchone()[0]
+                new_record = dict(record)
+                new_record['id'] = new_id
+                new_record.setdefault('votes', 0)
+                conn.execute('INSERT OR IGNORE INTO daily_lists (list_date) VALUES (?)', (date_str,))
+                self._insert(conn, date_str, new_record)
+            return ADD_OK, new_record
+        except sqlite3.IntegrityError:
+            # 唯一索引兜底（理论上已在事务内检查过）
+            return ADD_DUPLICATE_SONG, None
+        except sqlite3.Error:
+            return ADD_ERROR, None
+
+    def vote(self, date_str, request_id):
+        """原子地为歌曲加一票，返回新的票数"""
+        try:
+            with self._transaction() as conn:
+                cursor = conn.execute(
+                    'UPDATE song_requests SET votes = votes + 1 WHERE list_date = ? AND id = ?',
+                    (date_str, request_id)
+                )
+                if cursor.rowcount == 0:
+                    return None
+                row = conn.execute(
+                    'SELECT votes FROM song_requests WHERE list_date = ? AND id = ?', (date_str, request_id)
+                ).fetchone()
+            return row[0]
+        except sqlite3.Error:
+            return None
+
+    def set_lyric(self, date_str, request_id, lyric):
+        """更新歌曲的歌词（保存在 extra 中）"""
+        try:
+            with self._transaction() as conn:
+                row = conn.execute(
+                    'SELECT extra FROM song_requests WHERE list_date = ? AND id = ?', (date_str, request_id)
+                ).fetchone()
+                if row is None:
+                    return False
+                extra = json.loads(row['extra'] or '{}')
+                extra['lyric'] = lyric
+                conn.execute(
+                    'UPDATE song_requests SET extra = ? WHERE list_date = ? AND id = ?',
+                    (json.dumps(extra, ensure_ascii=False), date_str, request_id)
+                )
+            return True
+        except sqlite3.Error:
+            return False
+
+    def delete(self, date_str, request_ids):
+        request_ids = list(request_ids)
+        try:
+            with self._transaction() as conn:
+                deleted = 0
+                for request_id in request_ids:
+                    deleted += conn.execute(
+                        'DELETE FROM song_requests WHERE list_date = ? AND id = ?', (date_str, request_id)
+                    ).rowcount
+            return deleted
+        except sqlite3.Error:
+            return None
+
+    def remove_list(self, date_str):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM song_requests WHERE list_date = ?', (date_str,))
+            removed = conn.execute('DELETE FROM daily_lists WHERE list_date = ?', (date_str,)).rowcount
+        return removed > 0
+
+    def list_dates(self):
+        rows = self._conn().execute('SELECT list_date FROM daily_lists ORDER BY list_date DESC').fetchall()
+        return [row[0] for row in rows]
+
+    def compact(self):
+        """把 WAL 检查点写回主数据库文件"""
+        self._conn().execute('PRAGMA wal_checkpoint(PASSIVE)')
+        return 1
+
+
+class _Transaction(object):
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK，写锁在事务开始时获取"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
+
+
+def create_storage(backend, data_dir, sqlite_path=None, fsync_window=0.005):
+    """根据配置创建存储后端"""
+    if backend == 'json':
+        return JsonStorage(data_dir)
+    if backend == 'journal':
+        return JournalStorage(data_dir, fsync_window=fsync_window)
+    if backend == 'sqlite':
+        return SqliteStorage(sqlite_path or os.path.join(data_dir, 'music.db'))
+    raise ValueError(f"未知的存储后端: {backend}")
+
+
+def migrate_json_to_sqlite(data_dir, sqlite_path, overwrite=False):
+    """
+    一次性把 data/YYYY-MM-DD.json 导入 SQLite
+    已存在的日期默认跳过；违反唯一约束的重复记录会被跳过并计数
+    """
+    source = JsonStorage(data_dir)
+    target = SqliteStorage(sqlite_path)
+    stats = {'dates': 0, 'skipped_dates': 0, 'songs': 0, 'skipped_songs': 0}
+
+    for date_str in sorted(source.list_dates()):
+        if target.exists(date_str) and not overwrite:
+            stats['skipped_dates'] += 1
+            continue
+
+        with target._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO daily_lists (list_date) VALUES (?)', (date_str,))
+            conn.execute('DELETE FROM song_requests WHERE list_date = ?', (date_str,))
+            for record in source.load(date_str):
+                try:
+                    conn.execute('SAVEPOINT song')
+                    SqliteStorage._insert(conn, date_str, record)
+                    conn.execute('RELEASE song')
+                    stats['songs'] += 1
+                except (sqlite3.IntegrityError, KeyError) as e:
+                    conn.execute('ROLLBACK TO song')
+                    conn.execute('RELEASE song')
+                    stats['skipped_songs'] += 1
+                    print(f"[{date_str}] 跳过记录 {record.get('id')} {record.get('song_name')}: {e}")
+        stats['dates'] += 1
+
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='点歌列表存储工具')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='把每日JSON文件导入SQLite')
+    migrate_parser.add_argument('--data-dir', default='data', help='JSON文件所在目录')
+    migrate_parser.add_argument('--db', default=None, help='SQLite数据库路径（默认 data/music.db）')
+    migrate_parser.add_argument('--overwrite', action='store_true', help='覆盖数据库中已有的日期')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        db_path = args.db or os.path.join(args.data_dir, 'music.db')
+        result = migrate_json_to_sqlite(args.data_dir, db_path, overwrite=args.overwrite)
+        print(f"导入完成: {result['dates']} 天, {result['songs']} 首歌曲; "
+              f"跳过 {result['skipped_dates']} 天, {result['skipped_songs']} 条重复记录")
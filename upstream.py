@@ -0,0 +1,304 @@
+# upstream.py - 上游接口和音乐CDN的共享HTTP客户端
+"""
+所有对外请求（api.zh-mc.top 接口、歌曲CDN）共用一个 requests.Session：
+
+- 连接池复用 TCP/TLS 连接，池大小与并发的 worker 数量一致
+- 连接超时和读取超时分开设置
+- 连接失败、超时和 429/5xx 响应按指数退避 + 随机抖动重试
+- 按主机记录请求次数、错误、重试和延迟
+- 配置 limiter 时，每次请求前按 (主机, 当前线程的优先级) 取得限流额度
+- 配置熔断器的主机连续失败（或响应过慢）达到阈值后熔断，熔断期间直接抛出
+  CircuitOpen，不再等待超时；熔断 reset_timeout 秒后放行一个探测请求，成功则恢复
+- download() 把文件下载到 .part 文件，中断后用 Range 请求续传，
+  校验长度完整后才返回
+"""
+import os
+import re
+import time
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class IncompleteDownload(Exception):
+    """多次续传后文件仍不完整"""
+
+
+class CircuitOpen(Exception):
+    """上游已熔断，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, host, retry_after):
+        super(CircuitOpen, self).__init__(f"{host} 暂时不可用，请 {retry_after:.1f} 秒后再试")
+        self.host = host
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """单个主机的熔断器：closed（正常）-> open（熔断）-> half_open（探测）"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, host, failure_threshold=5, slow_call_seconds=5, reset_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.changed_at = time.time()
+        self.rejected = 0
+        self.transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        self.state = state
+        self.changed_at = time.time()
+        self.transitions[state] += 1
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+        print(f"上游熔断器 {self.host}: {state}")
+
+    def before(self):
+        """请求前调用，熔断中抛出 CircuitOpen"""
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpen(self.host, remaining)
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                # 同时只放行一个探测请求
+                if self._probing:
+                    self.rejected += 1
+                    raise CircuitOpen(self.host, 1)
+                self._probing = True
+
+    def release(self):
+        """before() 放行后请求没有发出时调用，交还探测名额"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+
+    def record(self, ok):
+        """请求结束后调用，ok 为 False 表示失败或响应过慢"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                self.failures = 0 if ok else self.failures
+                self._transition(self.CLOSED if ok else self.OPEN)
+            elif ok:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                    self._transition(self.OPEN)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'rejected': self.rejected,
+                'transitions': dict(self.transitions),
+                'changed_at': self.changed_at,
+            }
+
+
+class _HostStats(object):
+    def __init__(self, window):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.latencies = deque(maxlen=window)  # 最近的请求延迟（秒）
+
+
+class UpstreamClient(object):
+    """带连接池、重试和延迟统计的HTTP客户端"""
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 retries=2, backoff=0.3, headers=None, latency_window=200, limiter=None,
+                 breakers=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.latency_window = latency_window
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.limiter = limiter
+        self.breakers = {breaker.host: breaker for breaker in (breakers or [])}
+        self._local = threading.local()
+
+    @contextmanager
+    def priority(self, name):
+        """在 with 块内，当前线程发出的请求使用指定的限流优先级（默认 interactive）"""
+        previous = getattr(self._local, 'priority', None)
+        self._local.priority = name
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def current_priority(self):
+        return getattr(self._local, 'priority', None) or 'interactive'
+
+    def _timeout(self, timeout):
+        """timeout 可以是 (连接, 读取) 元组；只给一个数字时作为读取超时"""
+        if timeout is None:
+            return (self.connect_timeout, self.read_timeout)
+        if isinstance(timeout, (tuple, list)):
+            return tuple(timeout)
+        return (self.connect_timeout, timeout)
+
+    def _record(self, host, seconds, error=False, retry=False):
+        with self._lock:
+            stats = self._hosts.get(host)
+            if stats is None:
+                stats = self._hosts[host] = _HostStats(self.latency_window)
+            if retry:
+                stats.retries += 1
+                return
+            stats.requests += 1
+            stats.total_seconds += seconds
+            stats.latencies.append(seconds)
+            if error:
+                stats.errors += 1
+
+    def request(self, method, url, timeout=None, retries=None, **kwargs):
+        """
+        发送请求并返回 Response（不检查状态码，调用方自行 raise_for_status）
+        stream=True 时延迟只统计到收到响应头为止
+        额度用完时抛出 ratelimit.RateLimited，主机熔断时抛出 CircuitOpen
+        """
+        host = urlsplit(url).netloc
+        breaker = self.breakers.get(host)
+        timeout = self._timeout(timeout)
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            # 先检查熔断器：熔断期间直接拒绝，不消耗限流额度，也不等待
+            if breaker is not None:
+                breaker.before()
+            if self.limiter is not None:
+                try:
+                    self.limiter.acquire(host, self.current_priority())
+                except Exception:
+                    if breaker is not None:
+                        breaker.release()
+                    raise
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self._record(host, time.monotonic() - started, error=True)
+                if breaker is not None:
+                    breaker.record(False)
+                if attempt >= retries:
+                    raise
+            except Exception:
+                if breaker is not None:
+                    breaker.record(False)
+                raise
+            else:
+                elapsed = time.monotonic() - started
+                failed = response.status_code in RETRY_STATUS
+                self._record(host, elapsed, error=failed)
+                if breaker is not None:
+                    breaker.record(not failed and elapsed <= breaker.slow_call_seconds)
+                if not failed or attempt >= retries:
+                    return response
+                response.close()
+            attempt += 1
+            self._record(host, 0, retry=True)
+            time.sleep(self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def download(self, url, part_path, attempts=3, chunk_size=64 * 1024, **kwargs):
+        """
+        下载到 part_path（追加写入，已有内容时从断点续传），返回文件大小
+        服务器不支持 Range 时从头下载；传输中断或长度与 Content-Length 不符时
+        续传，最多 attempts 次，仍不完整则抛出 IncompleteDownload（保留 .part 供下次续传）
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        for attempt in range(attempts):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset:
+                headers['Range'] = f'bytes={offset}-'
+            else:
+                headers.pop('Range', None)
+            response = self.get(url, stream=True, headers=headers, **kwargs)
+            with response:
+                if response.status_code == 416:
+                    # 断点超出文件长度（例如上游文件已变化），从头下载
+                    os.remove(part_path)
+                    continue
+                response.raise_for_status()
+                expected = None
+                if response.status_code == 206:
+                    match = _CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                    if not match or int(match.group(1)) != offset:
+                        os.remove(part_path)
+                        continue
+                    if match.group(3) != '*':
+                        expected = int(match.group(3))
+                else:
+                    # 200：服务器忽略了 Range，整个文件重新下载
+                    offset = 0
+                    if response.headers.get('Content-Length'):
+                        expected = int(response.headers['Content-Length'])
+                mode = 'ab' if offset else 'wb'
+                try:
+                    with open(part_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError):
+                    self._record(urlsplit(url).netloc, 0, retry=True)
+                    continue
+            size = os.path.getsize(part_path)
+            if expected is None or size == expected:
+                return size
+            if size > expected:
+                os.remove(part_path)
+        raise IncompleteDownload(f"{attempts} 次尝试后文件仍不完整")
+
+    def breaker_stats(self):
+        return {host: breaker.stats() for host, breaker in self.breakers.items()}
+
+    def stats(self):
+        """按主机汇总的请求统计"""
+        result = {}
+        with self._lock:
+            for host, stats in self._hosts.items():
+                latencies = sorted(stats.latencies)
+                result[host] = {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'retries': stats.retries,
+                    'avg_ms': round(stats.total_seconds / stats.requests * 1000, 1) if stats.requests else 0.0,
+                    'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else 0.0,
+                    'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else 0.0,
+                }
+        return result
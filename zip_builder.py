@@ -0,0 +1,216 @@
+# zip_builder.py - 歌曲包后台打包任务
+"""
+管理后台“下载歌曲包”的打包任务。
+
+打包在后台线程中进行：缺少本地文件的歌曲并行下载（最多 workers 首同时进行），
+每首歌完成后立即写入ZIP。任务进度保存在 jobs_dir 下的 JSON 文件中，
+因此任何一个进程都可以查询进度。
+
+不指定 zip_path 时任务只负责把歌曲准备到本地，之后由 stream_zip 直接从
+下载目录读取文件、边打包边输出到响应，不生成临时副本和完整的ZIP文件。
+MP3 本身已经压缩过，成员一律使用 ZIP_STORED。
+"""
+import os
+import json
+import uuid
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+import zipfile
+
+from storage import atomic_write_json
+
+PENDING = 'pending'
+DOWNLOADING = 'downloading'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ZipJobManager(object):
+    """
+    fetch_func(song) -> (本地文件路径或None, 消息)
+    song 为 dict，至少包含 song_name 和 arcname（ZIP内的文件名）
+    """
+
+    def __init__(self, jobs_dir, fetch_func, workers=5, keep_days=1):
+        self.jobs_dir = jobs_dir
+        self.fetch_func = fetch_func
+        self.workers = workers
+        self.keep_days = keep_days
+        self._lock = threading.Lock()
+        self._running = {}  # key -> job_id，本进程中正在进行的任务
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _job_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def status(self, job_id):
+        """读取任务进度，任务不存在时返回 None"""
+        try:
+            uuid.UUID(job_id)
+        except ValueError:
+            return None
+        try:
+            with open(self._job_path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _cleanup(self):
+        """删除过期的任务记录"""
+        cutoff = datetime.now() - timedelta(days=self.keep_days)
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if datetime.fromtimestamp(os.path.getmtime(path)) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def start(self, key, songs, zip_path=None):
+        """
+        创建打包任务并在后台执行，返回任务ID
+        zip_path 为 None 时只准备文件（流式输出模式），不写ZIP
+        同一个 key（例如同一天的列表）已有任务在进行时直接返回该任务
+        """
+        with self._lock:
+            job_id = self._running.get(key)
+            if job_id:
+                return job_id
+            job_id = uuid.uuid4().hex
+            self._running[key] = job_id
+
+        self._cleanup()
+        job = {
+            'job_id': job_id,
+            'status': 'running',
+            'message': '',
+            'total': len(songs),
+            'completed': 0,
+            'success_count': 0,
+            'error_count': 0,
+            'zip_name': os.path.basename(zip_path) if zip_path else None,
+            'created_at': datetime.now().isoformat(),
+            'finished_at': None,
+            'items': [{
+                'song_name': song['song_name'],
+                'arcname': song['arcname'],
+                'state': PENDING,
+                'message': '',
+                'file': None,
+            } for song in songs],
+        }
+        atomic_write_json(self._job_path(job_id), job)
+        threading.Thread(target=self._run, args=(key, job, songs, zip_path),
+                         name=f'zip-job-{job_id[:8]}', daemon=True).start()
+        return job_id
+
+    def _run(self, key, job, songs, zip_path):
+        job_lock = threading.Lock()
+
+        def save():
+            atomic_write_json(self._job_path(job['job_id']), job)
+
+        def fetch(index):
+            with job_lock:
+                job['items'][index]['state'] = DOWNLOADING
+                save()
+            return self.fetch_func(songs[index])
+
+        part_path = f"{zip_path}.{job['job_id'][:8]}.part" if zip_path else None
+        try:
+            # ZIP只在当前线程中写入，下载线程只负责把文件准备到本地
+            archive = zipfile.ZipFile(part_path, 'w', compression=zipfile.ZIP_STORED) if zip_path else nullcontext()
+            with archive as zipf, \
+                    ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {pool.submit(fetch, i): i for i in range(len(songs))}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    item = job['items'][index]
+                    try:
+                        file_path, message = future.result()
+                        if file_path and zipf is not None:
+                            zipf.write(file_path, arcname=item['arcname'])
+                    except Exception as e:
+                        file_path, message = None, f"处理失败: {str(e)}"
+                    with job_lock:
+                        item['state'] = DONE if file_path else FAILED
+                        item['message'] = message
+                        item['file'] = file_path
+                        job['completed'] += 1
+                        if file_path:
+                            job['success_count'] += 1
+                        else:
+                            job['error_count'] += 1
+                        save()
+            if zip_path:
+                os.replace(part_path, zip_path)
+            job['status'] = 'done'
+            job['message'] = f"打包完成: 成功 {job['success_count']} 首，失败 {job['error_count']} 首"
+        except Exception as e:
+            job['status'] = 'error'
+            job['message'] = f"打包失败: {str(e)}"
+            if part_path:
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+        finally:
+            job['finished_at'] = datetime.now().isoformat()
+            with job_lock:
+                save()
+            with self._lock:
+                self._running.pop(key, None)
+
+
+class _StreamSink(object):
+    """zipfile 的输出对象：不可 seek，写入的数据暂存到下一次取出"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(members, chunk_size=64 * 1024):
+    """
+    按顺序把 members [(本地文件路径, ZIP内文件名), ...] 打包为ZIP并逐块产出
+    文件直接从原位置读取；缺失的文件跳过
+    """
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for file_path, arcname in members:
+            try:
+                src = open(file_path, 'rb')
+            except OSError:
+                continue
+            with src:
+                zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with zipf.open(zinfo, 'w') as dest:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data